@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+import cv2
+import numpy as np
+from filter import is_rainy_video
+from processor_utils import read_video
+from processor_utils_spanet import computer_percentile, SPAN_gen_single
+from processor_utils_percentile import span_percentile
+from processor_utils_color import rgb_to_luma
+
+GOLDEN_PATH = Path(__file__).parent / 'benchmarks' / 'golden.json'
+
+def synthetic_frames(width, height, frames, streaks=40, seed=0, noise=4.0, jitter=0.05):
+    '''
+    Deterministic rainy clip: a textured background with bright, slightly
+    slanted streaks at random positions in every frame. Each frame also gets
+    its own illumination gain (up to +-jitter) and Gaussian sensor noise of
+    standard deviation noise, so pixel histograms have a spread and the SPAN
+    percentile and the detector's median absolute deviation are not trivially 0.
+
+    Returns
+    -------
+    uint8 array of shape (frames, height, width, 3) in RGB
+    '''
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    background = np.stack([
+        60 + 120 * xx / max(1, width - 1),
+        80 + 100 * yy / max(1, height - 1),
+        np.full((height, width), 110.0)], axis=-1)
+    background += rng.normal(0, 6, background.shape)
+    video = np.empty((frames, height, width, 3), dtype=np.uint8)
+    length = max(3, height // 10)
+    t = np.arange(length)
+    gains = 1 + rng.uniform(-jitter, jitter, frames)
+    for i in range(frames):
+        frame = background * gains[i] + rng.normal(0, noise, background.shape)
+        x0 = rng.integers(0, width, streaks)
+        y0 = rng.integers(0, height, streaks)
+        slope = rng.uniform(-0.3, 0.3, streaks)
+        ys = (y0[:, None] + t[None, :]) % height
+        xs = np.clip((x0[:, None] + slope[:, None] * t[None, :]).astype(int), 0, width - 1)
+        frame[ys, xs] += 70
+        video[i] = np.clip(frame, 0, 255)
+    return video
+
+def write_video(frames, path: Path, fps=30):
+    '''
+    Write RGB frames losslessly (FFV1) so decoded values are reproducible
+    '''
+    h, w = frames.shape[1:3]
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'FFV1'), fps, (w, h))
+    for frame in frames:
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+    writer.release()
+
+def digest(array):
+    array = np.ascontiguousarray(array)
+    return hashlib.sha1(str(array.shape).encode() + array.tobytes()).hexdigest()
+
+def measure(func, *args, **kwargs):
+    '''
+    Run func once
+
+    Returns
+    -------
+    result AND dict with wall time in seconds and peak traced Python/numpy
+    memory in bytes (child processes are not included)
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {'seconds': seconds, 'peak_bytes': peak}
+
+def case_sparsity(frames):
+    '''
+    SPAN frame count of a case, a third of the clip so it differs between
+    clip lengths
+    '''
+    return max(2, frames // 3)
+
+def run_case(width, height, frames, tmp_dir: Path):
+    '''
+    Time every processing hot path on one synthetic clip
+
+    Returns
+    -------
+    dict keyed by stage with timings, memory, and an output digest
+    '''
+    results = {}
+    video = synthetic_frames(width, height, frames)
+    video_path = tmp_dir / f'synthetic_{width}x{height}_{frames}.avi'
+    write_video(video, video_path)
+
+    scene = {
+        'l': 0, 'r': -1, 't': 0, 'b': -1,
+        'rainy_video_path': video_path,
+        'clean_video_path': video_path,
+        'start_frame': 0,
+        'num_frames': frames,
+        'seconds': -1,
+        'clean_frame': 0,
+        'sparsity': case_sparsity(frames),
+        'name': 'synthetic',
+    }
+    (ret, decoded), stats = measure(read_video, scene)
+    results['read_video'] = {**stats, 'output': digest(decoded)}
+
+    y = rgb_to_luma(video[:scene['sparsity']])
+    percentile, stats = measure(computer_percentile, y)
+    results['computer_percentile'] = {**stats, 'output': int(percentile)}
+
+    percentile, stats = measure(span_percentile, y)
+    results['span_percentile'] = {**stats, 'output': int(percentile)}
+
+    span, stats = measure(SPAN_gen_single, video, scene['sparsity'])
+    results['SPAN_gen_single'] = {**stats, 'output': digest(span)}
+
+    cap = cv2.VideoCapture(str(video_path))
+    rainy, stats = measure(is_rainy_video, cap, -1, 2.0, (8, 8))
+    cap.release()
+    results['is_rainy_video'] = {**stats, 'output': [bool(rainy[0]), round(float(rainy[5]), 6)]}
+    return results
+
+def check_golden(report, golden):
+    '''
+    Compare stage outputs with the stored golden outputs. Adds 'golden' to
+    every stage: 'match', 'MISMATCH', or 'new' if there is no stored value.
+
+    Returns
+    -------
+    number of mismatches
+    '''
+    mismatches = 0
+    for case, stages in report['cases'].items():
+        for stage, result in stages.items():
+            expected = golden.get(case, {}).get(stage)
+            if expected is None:
+                result['golden'] = 'new'
+            elif expected == result['output']:
+                result['golden'] = 'match'
+            else:
+                result['golden'] = 'MISMATCH'
+                mismatches += 1
+    return mismatches
+
+def startup_times(commands, repeats=5):
+    '''
+    Wall time of `rainy.py COMMAND -h` in a fresh interpreter, which is
+    dominated by imports
+
+    Returns
+    -------
+    dict keyed by command with the median and minimum seconds over repeats
+    '''
+    import statistics
+    import subprocess
+    rainy = Path(__file__).parent / 'rainy.py'
+    results = {}
+    for command in commands:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            p = subprocess.run([sys.executable, str(rainy), command, '-h'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            times.append(time.perf_counter() - start)
+            if p.returncode != 0:
+                print(f'[ERROR] rainy.py {command} -h failed: {p.stderr.decode().strip()}', file=sys.stderr)
+                break
+        results[command] = {'median_seconds': statistics.median(times), 'min_seconds': min(times), 'ok': p.returncode == 0}
+    return results
+
+def parse_sizes(text):
+    return [tuple(int(d) for d in size.split('x')) for size in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmarks the processing hot paths on synthetic rainy videos')
+    parser.add_argument('-s', '--sizes', type=str, default='160x90,320x180,640x360', help='comma separated WIDTHxHEIGHT resolutions. Default: 160x90,320x180,640x360')
+    parser.add_argument('-f', '--frames', type=str, default='30,100', help='comma separated clip lengths in frames. Default: 30,100')
+    parser.add_argument('-o', '--output', type=str, default='', help='file to write the JSON report to. Default: stdout')
+    parser.add_argument('--golden', type=str, default=str(GOLDEN_PATH), help=f'golden outputs file. Default: {GOLDEN_PATH}')
+    parser.add_argument('--startup', default=False, action='store_true', help='only measure the startup time of every rainy.py subcommand')
+    parser.add_argument('--repeats', type=int, default=5, help='runs per subcommand for --startup. Default 5.')
+    parser.add_argument('--update-golden', default=False, action='store_true', help='store the outputs of this run as the golden outputs')
+    args = parser.parse_args()
+
+    if args.startup:
+        from rainy import COMMANDS
+        report = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'startup': startup_times(COMMANDS, args.repeats),
+        }
+        text = json.dumps(report, indent=1)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(text)
+        else:
+            print(text)
+        return
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'cases': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for width, height in parse_sizes(args.sizes):
+            for frames in [int(f) for f in args.frames.split(',')]:
+                case = f'{width}x{height}x{frames}'
+                print(f'running {case}', file=sys.stderr)
+                report['cases'][case] = run_case(width, height, frames, Path(tmp_dir))
+    report['children_max_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    golden_path = Path(args.golden)
+    golden = {}
+    if golden_path.exists():
+        with open(golden_path) as f:
+            golden = json.load(f)
+    mismatches = check_golden(report, golden)
+
+    if args.update_golden:
+        for case, stages in report['cases'].items():
+            golden[case] = {stage: result['output'] for stage, result in stages.items()}
+        golden_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(golden_path, 'w') as f:
+            json.dump(golden, f, indent=1, sort_keys=True)
+
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if mismatches and not args.update_golden:
+        print(f'[ERROR] {mismatches} output(s) differ from {golden_path}', file=sys.stderr)
+        exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import datetime
+import os
+import re
+from pathlib import Path
+
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.webm', '.ts', '.mov', '.avi', '.flv')
+
+# downloader file names: <place>_<YYYY-MM-DD>_<HH-MM-SS>[_<weather>].mp4
+CLIP_NAME = re.compile(r'^(?P<place>.+)_(?P<time>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})(?:_(?P<weather>[^_]+))?$')
+
+def find_videos(folder, recursive: bool=False):
+    '''
+    Sorted paths of video files in folder, relative to folder. Sidecar files
+    such as the downloader's .json and .log files are skipped.
+    '''
+    if recursive:
+        paths = []
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            paths += [os.path.relpath(os.path.join(root, f), folder) for f in files]
+    else:
+        paths = os.listdir(folder)
+    return sorted(p for p in paths if os.path.splitext(p)[1].lower() in VIDEO_EXTENSIONS)
+
+def parse_clip_name(path):
+    '''
+    Returns
+    -------
+    place name AND datetime (UTC) of the download, or None, None
+    '''
+    m = CLIP_NAME.match(Path(path).stem)
+    if m is None:
+        return None, None
+    return m.group('place'), datetime.datetime.strptime(m.group('time'), '%Y-%m-%d_%H-%M-%S')
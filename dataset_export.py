@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+import argparse
+import io
+import json
+import os
+import re
+import sys
+import tarfile
+from pathlib import Path
+import numpy as np
+
+SHARD_DIR = 'shards'
+SHARD_BYTES = 1 << 30
+INDEX_SUFFIX = '.index.json'
+
+# letter in processor output names -> kind of frame
+KINDS = {'R': 'rainy', 'P': 'span', 'C': 'clean', 'M': 'mask', 'B': 'binary_mask'}
+FRAME_NAME = re.compile(r'^(?P<scene>.+)-Webcam-(?P<letter>[RPCMB])-(?P<number>\d+)$')
+
+def npy_bytes(array):
+    '''
+    Returns
+    -------
+    array serialized as a .npy file AND length of the .npy header
+    '''
+    f = io.BytesIO()
+    np.lib.format.write_array(f, np.ascontiguousarray(array), allow_pickle=False)
+    data = f.getvalue()
+    return data, len(data) - array.nbytes
+
+class ShardWriter:
+    '''
+    Writes arrays as .npy members of uncompressed tar shards named
+    <name>-000000.tar, <name>-000001.tar, ... starting a new shard once
+    shard_bytes is reached. Members follow the WebDataset convention
+    <key>.npy, and the byte offset of each array inside its shard is recorded
+    so it can be mapped without extracting.
+    '''
+    def __init__(self, directory: Path, name, shard_bytes=SHARD_BYTES):
+        self.directory = Path(directory)
+        self.name = name
+        self.shard_bytes = shard_bytes
+        self.shards = []
+        self.entries = []
+        self.tar = None
+
+    def _next_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+        path = self.directory / f'{self.name}-{len(self.shards):06d}.tar'
+        self.shards.append(path)
+        self.tar = tarfile.open(path, 'w')
+
+    def add(self, key, array, **fields):
+        '''
+        Append one array under key, extra fields are stored in its index entry
+        '''
+        if self.tar is None or self.tar.offset >= self.shard_bytes:
+            self._next_shard()
+        data, header_len = npy_bytes(array)
+        info = tarfile.TarInfo(key + '.npy')
+        info.size = len(data)
+        member_offset = self.tar.offset + len(info.tobuf(self.tar.format, self.tar.encoding, self.tar.errors))
+        self.tar.addfile(info, io.BytesIO(data))
+        entry = {
+            'key': key,
+            'shard': self.shards[-1].name,
+            'offset': member_offset + header_len,
+            'shape': list(array.shape),
+            'dtype': str(array.dtype),
+            **fields,
+        }
+        self.entries.append(entry)
+        return entry
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+        return self.shards
+
+def write_index(directory: Path, name, entries, **metadata):
+    path = Path(directory) / (name + INDEX_SUFFIX)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({'scene': name, **metadata, 'entries': entries}, f)
+    os.replace(tmp_path, path)
+    return path
+
+def export_scene(directory: Path, scene, frames, span_frame, clean_frame, sweep=None, masks=None, binary_masks=None, shard_bytes=SHARD_BYTES):
+    '''
+    Pack one scene's frames into tar shards with a sidecar index
+
+    Parameters
+    ----------
+    directory : Path
+        folder receiving <scene>-NNNNNN.tar and <scene>.index.json
+
+    scene : dict
+        scene from scene_index, its name, crop, and videos go in the index
+
+    frames, span_frame, clean_frame : np.ndarray
+        uint8 raw frames (N, H, W, 3), SPAN frame and clean frame (H, W, 3)
+
+    sweep : dict, Default: None
+        frame count -> SPAN frame, from SPAN_gen_sweep
+
+    masks, binary_masks : np.ndarray, Default: None
+        rain masks (N, H, W, 3) and binary rain masks (N, H, W)
+
+    shard_bytes : int, Default: 1 GiB
+        size after which a new shard is started
+
+    Returns
+    -------
+    list of Paths written (shards and index)
+    '''
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    name = scene['name']
+    for old in directory.glob(f'{name}-*.tar'):
+        if re.fullmatch(re.escape(name) + r'-\d{6}\.tar', old.name):
+            old.unlink()
+
+    writer = ShardWriter(directory, name, shard_bytes)
+    writer.add(f'{name}-Webcam-P-000', span_frame, kind='span', frame=0)
+    writer.add(f'{name}-Webcam-C-000', clean_frame, kind='clean', frame=scene['clean_frame'])
+    for count, frame in (sweep or {}).items():
+        writer.add(f'{name}-Webcam-P-{count:03d}-sweep', frame, kind='sweep', frames=count)
+    for i in range(frames.shape[0]):
+        writer.add(f'{name}-Webcam-R-{i:03d}', frames[i], kind='rainy', frame=i)
+        if masks is not None:
+            writer.add(f'{name}-Webcam-M-{i:03d}', masks[i], kind='mask', frame=i)
+            writer.add(f'{name}-Webcam-B-{i:03d}', binary_masks[i], kind='binary_mask', frame=i)
+    shards = writer.close()
+
+    index = write_index(directory, name, writer.entries,
+        crop={k: scene[k] for k in ('l', 'r', 't', 'b')},
+        rainy_video=str(scene['rainy_video_path']),
+        clean_video=str(scene['clean_video_path']),
+        sparsity=scene['sparsity'])
+    return shards + [index]
+
+class DatasetReader:
+    '''
+    Random access to packed scenes. Indexes of every scene in the folder are
+    read at start; arrays are memory-mapped from the shards on access.
+    '''
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.scenes = {}
+        self.entries = {}
+        for path in sorted(self.directory.glob('*' + INDEX_SUFFIX)):
+            with open(path) as f:
+                index = json.load(f)
+            self.scenes[index['scene']] = index
+            for entry in index['entries']:
+                self.entries[entry['key']] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def __getitem__(self, key):
+        entry = self.entries[key]
+        return np.memmap(self.directory / entry['shard'], dtype=entry['dtype'], mode='r',
+                         offset=entry['offset'], shape=tuple(entry['shape']))
+
+    def scene_keys(self, scene, kind=None):
+        '''
+        Keys of a scene in stored order, optionally only of one kind
+        ('rainy', 'span', 'clean', 'sweep', 'mask', 'binary_mask')
+        '''
+        return [e['key'] for e in self.scenes[scene]['entries'] if kind is None or e['kind'] == kind]
+
+def read_image(path: Path):
+    if path.suffix == '.npy':
+        return np.load(path)
+    from PIL import Image
+    return np.asarray(Image.open(path))
+
+def pack_folder(folder: Path, directory: Path, shard_bytes=SHARD_BYTES):
+    '''
+    Pack a dataset already written by processor.py as individual images. The
+    crop and videos are not known from the files, so the index of each scene
+    only records the frames.
+
+    Returns
+    -------
+    number of scenes packed
+    '''
+    folder = Path(folder)
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    scenes = 0
+    for scene_path in sorted(p for p in folder.iterdir() if p.is_dir() and p.name != SHARD_DIR):
+        files = []
+        for path in sorted(scene_path.iterdir()):
+            m = FRAME_NAME.match(path.stem)
+            if m is not None and path.is_file():
+                files.append((m, path))
+        for sub in ('mask', 'sweep'):
+            for path in sorted((scene_path / sub).glob('*')):
+                m = FRAME_NAME.match(path.stem)
+                if m is not None:
+                    files.append((m, path))
+        if not files:
+            continue
+        print(f'packing {scene_path.name}: {len(files)} files', file=sys.stderr)
+        writer = ShardWriter(directory, scene_path.name, shard_bytes)
+        for m, path in files:
+            kind = 'sweep' if path.parent.name == 'sweep' else KINDS[m.group('letter')]
+            key = path.stem + ('-sweep' if kind == 'sweep' else '')
+            writer.add(key, read_image(path), kind=kind, frame=int(m.group('number')))
+        writer.close()
+        write_index(directory, scene_path.name, writer.entries)
+        scenes += 1
+    return scenes
+
+def main():
+    parser = argparse.ArgumentParser(description='packs processor output into tar shards with a sidecar index, or lists a packed dataset')
+    parser.add_argument('folder', help='processor output folder to pack, or with --list a folder of shards')
+    parser.add_argument('-o', '--output', type=str, default='', help=f'folder to write shards to. Default: FOLDER/{SHARD_DIR}')
+    parser.add_argument('--shard-size', type=float, default=1.0, help='GiB after which a new shard is started. Default 1.')
+    parser.add_argument('--list', default=False, action='store_true', help='print the scenes and number of arrays of a packed dataset')
+    args = parser.parse_args()
+    folder = Path(args.folder).expanduser()
+
+    if args.list:
+        reader = DatasetReader(folder)
+        for scene in reader.scenes:
+            print(f'{scene},{len(reader.scene_keys(scene))}')
+        return
+    directory = Path(args.output).expanduser() if args.output else folder / SHARD_DIR
+    scenes = pack_folder(folder, directory, int(args.shard_size * (1 << 30)))
+    print(f'packed scenes: {scenes}')
+
+if __name__ == '__main__':
+    main()
@@ -6,24 +6,29 @@ import os
 import requests
 from pathlib import Path
 import subprocess
-import gspread
 import time
 import datetime
-from timezonefinder import TimezoneFinder
 import pytz
-import astral
-from astral.sun import sun
-import traceback
 import argparse
 import sys
 import json
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from fingerprint import load_index, frozen_places, looping_places
+from storage import POLICIES, maintain, free_bytes
+from downloader_cluster import ClusterMember
+from metrics import METRICS, LOG_FORMATS, get_logger, configure as configure_metrics
 
 dotenv.load_dotenv()
 API_KEYS = os.getenv('API_KEYS').split(",")
+WEATHER_URL = os.getenv('WEATHER_URL', 'https://api.openweathermap.org/data/2.5/weather')
 TEST = True if os.getenv('TEST').lower() == 'true' else False
 
 CONDITIONS = ("clear", "clouds", "fog", "mist", "rain", "snow")
 
+logger = get_logger('downloader')
+
 def find_weather(lat, lon, api_key):
     '''
     Return weather at a given latitude and longitude
@@ -43,13 +48,109 @@ def find_weather(lat, lon, api_key):
     -------
     str : Weather type
     '''
-    request_url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={api_key}"
-    r = requests.get(request_url)
+    request_url = f"{WEATHER_URL}?lat={lat}&lon={lon}&appid={api_key}"
+    with METRICS.timer('weather_call', lat=lat, lon=lon):
+        r = requests.get(request_url, timeout=30)
+    METRICS.incr('weather_responses', status=r.status_code)
     data = r.json()
     conditions = sorted([w["main"].lower() for w in data["weather"]])
     return conditions, data
 
-def download_ydl_ffmpeg(place, url, weather, dir: Path, quality="best", time_length="00:00:10.00", wait=True):
+def prepare_download(place, url, weather, dir: Path, quality="best", probe=None):
+    '''
+    Create the log of a new recording, get the stream's HLS manifest with
+    youtube-dl and, if asked, probe the stream. Safe to run for several places
+    at once in threads.
+
+    Parameters
+    ----------
+    place, url, weather, dir, quality, probe
+        as for download_ydl_ffmpeg
+
+    Returns
+    -------
+    manifest URL (None if the stream is unavailable or the probe rejected it),
+    youtube-dl process if it failed to retrieve the manifest (else None),
+    download path represented as Path object, AND open log file to pass to
+    start_recording (None unless a manifest is returned)
+    '''
+    # https://unix.stackexchange.com/questions/230481/how-to-download-portion-of-video-with-youtube-dl-command
+    now = datetime.datetime.utcnow()
+    time_str = f"{now.year:04}-{now.month:02}-{now.day:02}_{now.hour:02}-{now.minute:02}-{now.second:02}"
+    video_name = place+'_'+time_str+'_'+weather
+    download_path = dir / (video_name+'.mp4')
+    log_path = dir / (video_name+'.log')
+    
+    # create log
+    log = open(log_path, "x")
+
+    # get manifest with youtube-dl, links to HLS manifests are used directly
+    if url.split('?')[0].endswith('.m3u8'):
+        manifest = url
+    else:
+        youtube_dl_args = [
+            'youtube-dl',
+            '--youtube-skip-dash-manifest',
+            '-f', quality,
+            '-g', url]
+        p_manifest = subprocess.Popen(
+            youtube_dl_args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=log)
+        with METRICS.timer('manifest_resolve', place=place):
+            manifests = p_manifest.communicate()[0].decode().strip().split()
+        if len(manifests) == 0:
+            logger.error('livestream not available', place=place, url=url)
+            log.close()
+            return None, p_manifest, download_path, None
+        manifest = manifests[0]
+
+    # check a short sample of the stream before committing to a recording
+    if probe is not None:
+        probe = dict(probe)
+        if 'rain' not in weather.split('-'):
+            probe['rain_threshold'] = None
+        from stream_probe import probe_stream # imports the filter.py detector and OpenCV
+        ok, reason, stats = probe_stream(manifest, **probe)
+        logger.info('probe', place=place, ok=ok, reason=reason, **stats)
+        if not ok:
+            log.close()
+            log_path.unlink()
+            return None, None, download_path, None
+    return manifest, None, download_path, log
+
+def start_recording(place, manifest, download_path: Path, log, time_length="00:00:10.00", wait=True):
+    '''
+    Record time_length of an HLS manifest to download_path with ffmpeg. The
+    ffmpeg output goes to log, which is closed here.
+
+    Returns
+    -------
+    Popen subprocess object representing ffmpeg download
+    '''
+    # download with ffmpeg
+    ffmpeg_args = [
+        'ffmpeg',
+        '-f', 'hls',       # input format is hls
+        '-i', manifest,    # input manifest file link
+        '-t', time_length, # time length to record for
+        '-c', "copy",      # copy original codec
+        '-an',             # discard audio
+        str(download_path)]
+    logger.info('recording', place=place, path=download_path, command=' '.join(ffmpeg_args))
+    p_ffmpeg = subprocess.Popen(
+        ffmpeg_args,
+        stdin=subprocess.DEVNULL,
+        stdout=log,
+        stderr=subprocess.STDOUT)
+    if wait:
+        p_ffmpeg.wait()
+    
+    log.close()
+    return p_ffmpeg
+
+def download_ydl_ffmpeg(place, url, weather, dir: Path, quality="best", time_length="00:00:10.00", wait=True, probe=None):
     '''
     Downloading a video with youtube-dl and ffmpeg
 
@@ -76,12 +177,17 @@ def download_ydl_ffmpeg(place, url, weather, dir: Path, quality="best", time_len
     wait : bool, Default: True
         whether to wait for the download process to finish or not. If false, make
         sure to wait for the returned process to finish executing.
+
+    probe : dict, Default: None
+        if given, keyword arguments for stream_probe.probe_stream. A few seconds
+        of the stream are checked in memory first and nothing is recorded if
+        the check fails. The rain check only applies if weather includes rain.
     
     Returns
     -------
     Popen subprocess object representing ffmpeg download or youtube-dl process
-    if failed to retrieve manifest file and download path AND download path
-    represented as Path object AND associated weather
+    if failed to retrieve manifest file and download path, or None if the
+    probe rejected the stream, AND download path represented as Path object
 
     Side Effects
     ------------
@@ -89,57 +195,12 @@ def download_ydl_ffmpeg(place, url, weather, dir: Path, quality="best", time_len
         mp4 video saved to dir
         log file containing output from ffmpeg saved to dir
     '''
-    # https://unix.stackexchange.com/questions/230481/how-to-download-portion-of-video-with-youtube-dl-command
-    now = datetime.datetime.utcnow()
-    time_str = f"{now.year:04}-{now.month:02}-{now.day:02}_{now.hour:02}-{now.minute:02}-{now.second:02}"
-    video_name = place+'_'+time_str+'_'+weather
-    download_path = dir / (video_name+'.mp4')
-    log_path = dir / (video_name+'.log')
-    
-    # create log
-    log = open(log_path, "x")
-
-    # get manifest with youtube-dl
-    youtube_dl_args = [
-        'youtube-dl',
-        '--youtube-skip-dash-manifest',
-        '-f', quality,
-        '-g', url]
-    p_manifest = subprocess.Popen(
-        youtube_dl_args,
-        stdin=subprocess.DEVNULL,
-        stdout=subprocess.PIPE,
-        stderr=log)
-    manifests = p_manifest.communicate()[0].decode().strip().split()
-    if len(manifests) == 0:
-        print(f"[Error] livestream/video not available for {place} {url}")
-        log.close()
+    manifest, p_manifest, download_path, log = prepare_download(place, url, weather, dir, quality, probe)
+    if manifest is None:
         return p_manifest, download_path
-    manifest = manifests[0]
+    return start_recording(place, manifest, download_path, log, time_length, wait), download_path
 
-    # download with ffmpeg
-    print(f"Downloading to: {download_path}")
-    ffmpeg_args = [
-        'ffmpeg',
-        '-f', 'hls',       # input format is hls
-        '-i', manifest,    # input manifest file link
-        '-t', time_length, # time length to record for
-        '-c', "copy",      # copy original codec
-        '-an',             # discard audio
-        str(download_path)]
-    print("Command:", " ".join(ffmpeg_args))
-    p_ffmpeg = subprocess.Popen(
-        ffmpeg_args,
-        stdin=subprocess.DEVNULL,
-        stdout=log,
-        stderr=subprocess.STDOUT)
-    if wait:
-        p_ffmpeg.wait()
-    
-    log.close()
-    return p_ffmpeg, download_path
-
-def find_places(spreadsheet: gspread.Spreadsheet, daytime: bool=True, condition_excludes: Tuple[str]=()):
+def find_places(spreadsheet: 'gspread.Spreadsheet', daytime: bool=True, condition_excludes: Tuple[str]=(), assigned=None):
     '''
     Return a dictionary of places and their Youtube URLs that currently have rain
 
@@ -155,6 +216,11 @@ def find_places(spreadsheet: gspread.Spreadsheet, daytime: bool=True, condition_
 
     condition_excludes : Tuple[str]
         conditions to exclude from download
+
+    assigned : callable, Default: None
+        if given, only cities for which assigned(city) is True are checked,
+        e.g. ClusterMember.assigned so that each worker queries only its
+        shard. No lease is taken here, only for places that are recorded.
       
     Returns
     -------
@@ -164,34 +230,46 @@ def find_places(spreadsheet: gspread.Spreadsheet, daytime: bool=True, condition_
             Note that weather types are separated by hyphens '-'
     '''
     # parse spreadsheet data
-    metadata = spreadsheet.fetch_sheet_metadata()
+    with METRICS.timer('sheet_fetch', part='metadata'):
+        metadata = spreadsheet.fetch_sheet_metadata()
     number_of_sheets = len(metadata["sheets"])
     sheets_metadata = metadata["sheets"]
 
+    # timezonefinder and astral are slow to import and only needed for daytime checks
+    if daytime:
+        import astral
+        from astral.sun import sun
+        from timezonefinder import TimezoneFinder
+        timezone_finder = TimezoneFinder()
+
     # fill in places that have rain
     places = {}
     for i in range(number_of_sheets):
         title = sheets_metadata[i]["properties"]["title"]
-        print(f"Region: {title}")
-        rows = spreadsheet.get_worksheet(i).get_all_values()
+        logger.info('region', region=title)
+        with METRICS.timer('sheet_fetch', part='rows', region=title):
+            rows = spreadsheet.get_worksheet(i).get_all_values()
         for row in rows[1:]:
             city, lat, lon, url = row[0:4]
-            print(f"\t{(city + ':').ljust(20)} ", end='')
+            # skip places assigned to other workers of the cluster
+            if assigned is not None and not assigned(city):
+                logger.debug('skip', region=title, city=city, reason='other worker')
+                continue
 
             # check for forced skip in "Not Usable" column indicated by a case-insensitive 'X'
             if len(row) > 4:
                 if row[4].strip().lower() == 'x':
-                    print("SKIP - forced")
+                    logger.info('skip', region=title, city=city, reason='forced')
                     continue
 
             # skip if no latitude or longitude
             if lat == '' or lon == '':
-                print("SKIP - latitude or longitude not specified")
+                logger.info('skip', region=title, city=city, reason='no latitude or longitude')
                 continue
 
             # skip if daytime specified and location has no daylight
             if daytime:
-                timezone_str = TimezoneFinder().timezone_at(lng=float(lon), lat=float(lat))
+                timezone_str = timezone_finder.timezone_at(lng=float(lon), lat=float(lat))
                 loc = astral.LocationInfo(name='loc', region='region', timezone=timezone_str, latitude=lat, longitude=lon)
                 timezone_tzinfo = pytz.timezone(timezone_str)
                 
@@ -199,11 +277,10 @@ def find_places(spreadsheet: gspread.Spreadsheet, daytime: bool=True, condition_
                     s = sun(loc.observer, date=datetime.datetime.now(), tzinfo=loc.timezone)
                     hour = datetime.datetime.now(timezone_tzinfo).hour
                     if (hour < s['sunrise'].hour) or (hour > s['sunset'].hour):
-                        print(f"SKIP - dark")
+                        logger.info('skip', region=title, city=city, reason='dark')
                         continue
                 except Exception as e:
-                    print(f"SKIP - dark (assumed). ERROR: ", end="")
-                    print(e)
+                    logger.warning('skip', region=title, city=city, reason='dark (assumed)', error=repr(e))
                     continue
             
             # download if location is raining
@@ -213,16 +290,101 @@ def find_places(spreadsheet: gspread.Spreadsheet, daytime: bool=True, condition_
                     break
                 except:
                     continue
+            else:
+                logger.warning('skip', region=title, city=city, reason='weather request failed for every key')
+                continue
             for w in weather:
                 if w in condition_excludes:
-                    print(f"SKIP - EXCLUDE OpenWeatherMap API indicates {weather}")
+                    logger.info('skip', region=title, city=city, reason='excluded weather', weather='-'.join(weather))
                     break
             else:
-                print(f"DOWNLOAD - OpenWeatherMap API indicates {weather}")
+                logger.info('download', region=title, city=city, weather='-'.join(weather))
                 places[city] = [url, "best", '-'.join(weather), data]
     return places
 
-def download(places, seconds=10, tmp_dir=Path('./tmp'), final_dir=Path("./downloads"), timeout=True):
+def maintain_storage(folder: Path, storage_options, interval=300.0):
+    '''
+    Target of the storage thread: runs storage.maintain on folder every
+    interval seconds, so cold moves, transcodes and evictions do not hold up
+    the recording loop. Errors are logged and the next pass tries again.
+
+    Parameters
+    ----------
+    folder : Path
+        downloads folder
+
+    storage_options : dict
+        keyword arguments for storage.maintain
+
+    interval : float, Default: 300
+        seconds between the start of one pass and the next
+    '''
+    while True:
+        start = time.time()
+        try:
+            with METRICS.timer('storage'):
+                freed = maintain(folder, **storage_options)
+            METRICS.event('storage_maintained', freed_bytes=freed)
+        except Exception:
+            logger.exception('storage maintenance failed')
+        time.sleep(max(0, interval - (time.time() - start)))
+
+def route_verified_clip(video_path: Path, data_path: Path, threshold: float, discard_rejected: bool, future):
+    '''
+    Done-callback for a rain verification job. Records the detector result in
+    the weather JSON sidecar and moves the clip and sidecar into a verified or
+    rejected subfolder of the weather folder.
+
+    Parameters
+    ----------
+    video_path : Path
+        downloaded video in downloads/<date>/<weather>/
+
+    data_path : Path
+        weather JSON sidecar of the video
+
+    threshold : float
+        outlier percentage threshold the detector used
+
+    discard_rejected : bool
+        delete rejected videos, keeping only their sidecar
+
+    future : concurrent.futures.Future
+        finished filter.classify_file job
+    '''
+    try:
+        result = future.result()
+    except Exception as e:
+        logger.error('rain verification failed', clip=video_path, error=repr(e))
+        return
+    if result is None:
+        verification = {'rainy': False, 'error': 'no frames'}
+    else:
+        rainy, mu, sigma, outliers, frame_count, percent_outliers = result
+        verification = {
+            'rainy': bool(rainy),
+            'mean': float(mu),
+            'std': float(sigma),
+            'outliers': int(outliers),
+            'frames': int(frame_count),
+            'percent_outliers': float(percent_outliers),
+            'threshold': threshold}
+
+    with open(data_path) as datalogf:
+        data = json.load(datalogf)
+    data['rain_verification'] = verification
+    folder_path = video_path.parent / ('verified' if verification['rainy'] else 'rejected')
+    folder_path.mkdir(parents=True, exist_ok=True)
+    with open(folder_path / data_path.name, 'w') as datalogf:
+        json.dump(data, datalogf)
+    data_path.unlink()
+    if not verification['rainy'] and discard_rejected:
+        video_path.unlink()
+    else:
+        video_path.rename(folder_path / video_path.name)
+    logger.info('verify', clip=video_path.name, result='verified' if verification['rainy'] else 'rejected')
+
+def download(places, seconds=10, tmp_dir=Path('./tmp'), final_dir=Path("./downloads"), timeout=True, verify_pool=None, verify_options=None, probe=None, catalog=None, probe_jobs=32):
     '''
     auto-downloader logic
 
@@ -240,6 +402,24 @@ def download(places, seconds=10, tmp_dir=Path('./tmp'), final_dir=Path("./downlo
 
     final_dir : Path
         final directory where compeleted downloads are stored
+
+    verify_pool : concurrent.futures.Executor, Default: None
+        if given, clips labeled rain are checked with the filter.py detector
+        in this pool after they are moved, see route_verified_clip
+    
+    verify_options : dict, Default: None
+        frames, threshold, window, and discard_rejected for the verification
+
+    probe : dict, Default: None
+        probe options passed to prepare_download
+
+    catalog : callable, Default: None
+        called with a dict (place, clip, weather, exit_code, bytes, path) for
+        every recording, e.g. ClusterMember.record
+
+    probe_jobs : int, Default: 32
+        number of places whose manifests are fetched and streams probed at
+        the same time before the recordings start
     
     Returns
     -------
@@ -257,42 +437,60 @@ def download(places, seconds=10, tmp_dir=Path('./tmp'), final_dir=Path("./downlo
     # convert time to string format
     time_length_str = time.strftime('%H:%M:%S', time.gmtime(seconds))
 
-    # download from livestreams in places dictionary
-    processes = [
-        (*download_ydl_ffmpeg(
-            place,
-            url,
-            weather,
-            tmp_dir,
-            quality,
-            time_length_str, 
-            wait=False), weather, data) \
-        for place, (url, quality, weather, data) in places.items()]
+    # get the manifests of all livestreams in places dictionary and probe
+    # them at once, then start every recording that passed together, so
+    # start times do not drift apart by a probe per place
+    with ThreadPoolExecutor(max_workers=max(1, min(probe_jobs, len(places)))) as pool:
+        prepared = list(pool.map(
+            lambda item: prepare_download(item[0], item[1][0], item[1][2], tmp_dir, item[1][1], probe),
+            places.items()))
+    processes = []
+    for (place, (url, quality, weather, data)), (manifest, p, download_path, log) in zip(places.items(), prepared):
+        if manifest is not None:
+            p = start_recording(place, manifest, download_path, log, time_length_str, wait=False)
+        processes.append((p, download_path, weather, data))
+    clip_places = {download_path: place for (_, download_path, _, _), place in zip(processes, places)}
+    processes = [(p, download_path, weather, data) for p, download_path, weather, data in processes if p is not None]
     
     start_time = time.time()
-    print(f"Attempting download of {len(processes)} video(s).")
+    logger.info('capture started', videos=len(processes))
 
     # Sometimes downloads go into an infinite loop. To mitigate this,
     # this while loop constantly checks the return codes to see if the
     # processes have completed. If one of the processes exceeds
     # 1.5*seconds+60, the process is killed and its temporary file removed.
+    finish_times = {}
     while True and timeout:
         time.sleep(1)
         return_codes = [p.poll() for p, _, _, _ in processes]
+        for i, r in enumerate(return_codes):
+            if r is not None and i not in finish_times:
+                finish_times[i] = time.time()
         return_codes_not_None = [r for r in return_codes if r is not None]
         if len(return_codes_not_None) == len(processes):
             break
         elif time.time() > start_time + 1.25*seconds + 60:
             for p, download_path, _, _ in processes:
                 if p.returncode != 0:
-                    print("Killing...")
+                    logger.warning('killing recording', path=download_path)
                     p.kill()
                     p.wait()
                     subprocess.call([f"rm -f '{download_path}'"], shell=True)
             break
     
     exit_codes = [p.wait() for p, _, _, _ in processes]
-    print(exit_codes)
+    logger.info('capture finished', exit_codes=exit_codes)
+
+    # ffmpeg runtime and bytes for every recording
+    sizes = []
+    for i, (p, download_path, weather, _) in enumerate(processes):
+        runtime = finish_times.get(i, time.time()) - start_time
+        size = download_path.stat().st_size if download_path.exists() else 0
+        sizes.append(size)
+        METRICS.observe('ffmpeg_seconds', runtime)
+        METRICS.incr('ffmpeg_bytes', size)
+        METRICS.incr('captures', status='ok' if p.returncode == 0 else 'failed')
+        METRICS.event('ffmpeg', clip=download_path.name, weather=weather, seconds=runtime, bytes=size, exit_code=p.returncode)
 
     # move downloaded videos from temporary directory to permanent directory
     # only if successfully downloaded (exit code 0)
@@ -305,6 +503,33 @@ def download(places, seconds=10, tmp_dir=Path('./tmp'), final_dir=Path("./downlo
             subprocess.call([f"mv '{download_path}' '{weather_folder_path}'"], shell=True)
             with open(data_path, 'w') as datalogf:
                 json.dump(data, datalogf)
+
+            # check in the background that the clip actually shows rain
+            if verify_pool is not None and 'rain' in weather.split('-'):
+                from filter import classify_file # only with --verify, it imports OpenCV
+                video_path = weather_folder_path / download_path.name
+                future = verify_pool.submit(
+                    classify_file,
+                    str(video_path),
+                    verify_options['frames'],
+                    verify_options['threshold'],
+                    verify_options['window'])
+                future.add_done_callback(partial(
+                    route_verified_clip,
+                    video_path,
+                    data_path,
+                    verify_options['threshold'],
+                    verify_options['discard_rejected']))
+
+    if catalog is not None:
+        for (p, download_path, weather, _), size in zip(processes, sizes):
+            catalog({
+                'place': clip_places[download_path],
+                'clip': download_path.name,
+                'weather': weather,
+                'exit_code': p.returncode,
+                'bytes': size,
+                'path': str(final_dir / folder_day_name / weather / download_path.name) if p.returncode == 0 else None})
     return exit_codes, folder_path
 
 
@@ -324,12 +549,42 @@ def main():
     parser.add_argument('-e', '--extra', type=int, default=1, help='number of extra videos to download after the OpenWeatherMap API says it stops raining. Default 1.')
     parser.add_argument('--exclude', type=str, default="", help=f'weather condition to exclude. Choose from {CONDITIONS} and separate by commma without spacing.')
     parser.add_argument('-d', '--daytime', default=False, action='store_true', help='for each video download ONLY when it is daytime.')
+    parser.add_argument('--probe', default=False, action='store_true', help='check a few seconds of each stream in memory and skip recording if it is dark, frozen, or shows no rain.')
+    parser.add_argument('--probe-seconds', type=int, default=3, help='seconds of the stream to probe. Default 3.')
+    parser.add_argument('--probe-dark', type=float, default=25.0, help='mean intensity (0-255) below which a stream is considered dark. Default 25.')
+    parser.add_argument('--probe-frozen', type=float, default=0.5, help='mean absolute frame difference below which a stream is considered frozen. Default 0.5.')
+    parser.add_argument('--probe-rain-threshold', type=float, default=2.0, help='percentage of outliers the probe needs to see for rain clips, negative to disable the rain check. Default 2.0.')
+    parser.add_argument('--fingerprints', type=str, default='', help='folder with a fingerprint.py index. Places whose latest clip is frozen or a duplicate of an earlier clip are skipped until that clip is --frozen-recheck-hours old.')
+    parser.add_argument('--frozen-recheck-hours', type=float, default=6.0, help='hours after which a place with a frozen or duplicate clip is recorded again. Default 6.')
+    parser.add_argument('--min-free-gb', type=float, default=2.0, help='pause recording while the downloads folder\'s disk has less than this many GB free. Default 2.')
+    parser.add_argument('--quota-gb', type=float, default=-1, help='evict clips so the downloads folder uses at most this many GB, negative for no quota. Default -1.')
+    parser.add_argument('--eviction-policy', type=str, default='oldest', choices=tuple(POLICIES), help='order in which clips are evicted for --quota-gb. Default: oldest')
+    parser.add_argument('--cold-dir', type=str, default='', help='move evicted clips and cold days here instead of deleting them, e.g. a larger, slower disk')
+    parser.add_argument('--cold-after-days', type=int, default=-1, help='move day folders at least this many days old to --cold-dir, negative to disable. Default -1.')
+    parser.add_argument('--transcode-crf', type=int, default=-1, help='re-encode clips moved to --cold-dir with H.264 at this CRF, negative to move as is. Default -1.')
+    parser.add_argument('--storage-interval', type=float, default=5.0, help='minutes between storage passes (quota, cold moves, tmp cleanup), which run in a background thread. Default 5.')
+    parser.add_argument('--tmp-max-age', type=float, default=6.0, help='hours after which ffmpeg logs and failed partial recordings in ./tmp are removed. Default 6.')
+    parser.add_argument('--cluster-dir', type=str, default='', help='folder shared by several downloader2.py workers, e.g. on NFS. The sheet\'s places are split between the live workers and a dead worker\'s places are taken over once its lease expires.')
+    parser.add_argument('--worker-id', type=str, default='', help='name of this worker in --cluster-dir. Default: HOSTNAME-PID')
+    parser.add_argument('--lease-seconds', type=float, default=120.0, help='seconds a worker\'s heartbeat and place leases stay valid without renewal, the failover delay. Default 120.')
+    parser.add_argument('--metrics', type=str, default='', help='append per-stage timings and recording results as JSON lines to this file.')
+    parser.add_argument('--metrics-port', type=int, default=0, help='serve Prometheus metrics on this port at /metrics.')
+    parser.add_argument('--log-format', type=str, default='text', choices=LOG_FORMATS, help='text: message followed by key=value fields; json: one JSON object per line. Default: text')
+    parser.add_argument('--verify', default=False, action='store_true', help='check rain clips with the filter.py detector and move them to verified/ or rejected/ subfolders.')
+    parser.add_argument('--verify-jobs', type=int, default=2, help='number of processes verifying clips in the background. Default 2.')
+    parser.add_argument('--verify-frames', type=int, default=300, help='number of frames the detector analyses, negative for all. Default 300.')
+    parser.add_argument('--verify-threshold', type=float, default=2.0, help='detector threshold for the percentage of outliers. Default 2.0.')
+    parser.add_argument('--verify-window', type=int, default=2, help='detector nxn window of pixels in the center of the image. Default 2.')
+    parser.add_argument('--discard-rejected', default=False, action='store_true', help='delete clips the detector rejects, keeping their JSON sidecar.')
 
     # parse arguments
     args = parser.parse_args()
+    if args.cold_after_days >= 0 and not args.cold_dir:
+        parser.error('--cold-after-days requires --cold-dir')
+    configure_metrics(args.metrics, args.metrics_port, args.log_format)
     downloads_folder = Path(args.downloads_folder).expanduser()
     timeout = not args.notimeout
-    print("ENABLED timeout") if timeout else print("DISABLED timeout")
+    logger.info('option', timeout=timeout)
     sheet_name = args.sheet
     extra = int(args.extra)
 
@@ -337,13 +592,51 @@ def main():
     condition_excludes = [c.lower() for c in condition_excludes]
     for c in condition_excludes:
         if c not in CONDITIONS:
-            print(f"[ERROR] invalid condition to exclude. Choose from {CONDITIONS}.", file=sys.stderr)
+            logger.error('invalid condition to exclude', condition=c, choices=','.join(CONDITIONS))
             exit(1)
-    print(f"EXCLUDE {condition_excludes}")
+    logger.info('option', exclude=','.join(condition_excludes))
     
     daytime = bool(args.daytime)
-    print("ENABLED daytime only") if daytime else print("DISABLED daytime only")
-
+    logger.info('option', daytime_only=daytime)
+
+    verify_pool = None
+    verify_options = None
+    if args.verify:
+        verify_pool = ProcessPoolExecutor(max_workers=args.verify_jobs)
+        verify_options = {
+            'frames': args.verify_frames,
+            'threshold': args.verify_threshold,
+            'window': (args.verify_window, args.verify_window),
+            'discard_rejected': args.discard_rejected}
+    logger.info('option', rain_verification=args.verify)
+
+    probe = None
+    if args.probe:
+        probe = {
+            'seconds': args.probe_seconds,
+            'dark': args.probe_dark,
+            'frozen': args.probe_frozen,
+            'rain_threshold': None if args.probe_rain_threshold < 0 else args.probe_rain_threshold}
+    logger.info('option', stream_probe=args.probe)
+
+    storage_options = {
+        'quota_bytes': int(args.quota_gb * 1e9) if args.quota_gb >= 0 else None,
+        'policy': args.eviction_policy,
+        'cold_dir': Path(args.cold_dir).expanduser() if args.cold_dir else None,
+        'cold_after_days': args.cold_after_days if args.cold_after_days >= 0 else None,
+        'crf': args.transcode_crf if args.transcode_crf >= 0 else None,
+        'tmp_dir': Path('./tmp'),
+        'tmp_max_age_hours': args.tmp_max_age}
+    downloads_folder.mkdir(parents=True, exist_ok=True)
+    threading.Thread(target=maintain_storage, args=(downloads_folder, storage_options, args.storage_interval * 60), daemon=True).start()
+    logger.info('option', min_free_gb=args.min_free_gb, storage_interval_minutes=args.storage_interval)
+
+    cluster = None
+    if args.cluster_dir:
+        cluster = ClusterMember(Path(args.cluster_dir).expanduser(), args.worker_id or None, args.lease_seconds)
+    logger.info('option', cluster_worker=cluster.worker_id if cluster is not None else None)
+
+    import gspread
     gc = gspread.service_account(filename="google-sheet-service-auth.json")
 
     # In this pipeline we also want to download video(s) without rain immediately
@@ -359,14 +652,46 @@ def main():
     places_to_download = {}
     places_extra = {}
     while True:
+        # pause recording while the disk is nearly full; the storage thread frees space meanwhile.
+        # This runs before the scan so a paused loop makes no weather requests and leaves the extras untouched.
+        free = free_bytes(downloads_folder)
+        METRICS.event('storage_free', free_bytes=free)
+        if free < args.min_free_gb * 1e9:
+            logger.warning('pause', reason='low disk space', free_gb=round(free / 1e9, 1), min_free_gb=args.min_free_gb, wait_seconds=60)
+            METRICS.incr('admission_paused')
+            if cluster is not None:
+                cluster.release_except(())
+            time.sleep(60)
+            continue
+
+        if cluster is not None:
+            workers = cluster.refresh()
+            logger.info('cluster', live_workers=len(workers))
         try:
-            spreadsheet = gc.open(sheet_name)
-            places_new = find_places(spreadsheet, daytime=daytime, condition_excludes=condition_excludes)
+            with METRICS.timer('scan'):
+                spreadsheet = gc.open(sheet_name)
+                places_new = find_places(spreadsheet, daytime=daytime, condition_excludes=condition_excludes, assigned=cluster.assigned if cluster is not None else None)
         except:
-            print(traceback.format_exc())
-            print('Error opening spreadsheet or gettng rainy places, continuing...')
+            logger.exception('error opening spreadsheet or getting rainy places, continuing')
             places_new = {}
 
+        # deprioritize webcams that recently produced a frozen or looping clip
+        if args.fingerprints:
+            try:
+                index = load_index(Path(args.fingerprints).expanduser())
+                frozen = frozen_places(index, args.frozen_recheck_hours)
+                looping = looping_places(index, args.frozen_recheck_hours)
+            except Exception:
+                logger.exception('reading fingerprint index failed')
+                frozen, looping = set(), set()
+            for place in list(places_new):
+                if place in frozen:
+                    logger.info('skip', city=place, reason='latest clip frozen')
+                    del places_new[place]
+                elif place in looping:
+                    logger.info('skip', city=place, reason='latest clip repeats an earlier clip')
+                    del places_new[place]
+
         # append the number of times the video should be downloaded after it stops raining
         # add one to account for decrement
         for place in places_new:
@@ -380,15 +705,26 @@ def main():
                 del places_to_download[place]
                 del places_extra[place]
             elif places_extra[place] < extra:
-                print(f'EXTRA: Downloading {place} {places_extra[place]} more times')
+                logger.info('extra', city=place, remaining=places_extra[place])
+
+        # take the lease of every place to record, handing off places the ring moved
+        # to another worker or whose lease the previous worker still holds
+        if cluster is not None:
+            for place in list(places_to_download):
+                if not cluster.owns(place):
+                    logger.info('handoff', city=place, reason='assigned to another worker or still leased')
+                    del places_to_download[place]
+                    places_extra.pop(place, None)
+            cluster.release_except(places_to_download)
 
         # download
-        exit_codes, _ = download(places_to_download, seconds=120, final_dir=downloads_folder, timeout=timeout)
+        with METRICS.timer('capture', places=len(places_to_download)):
+            exit_codes, _ = download(places_to_download, seconds=120, final_dir=downloads_folder, timeout=timeout, verify_pool=verify_pool, verify_options=verify_options, probe=probe, catalog=cluster.record if cluster is not None else None)
         if len(exit_codes) == 0:
-            print("No videos to download, waiting 60 seconds...")
+            logger.info('idle', reason='no videos to download', wait_seconds=60)
             time.sleep(60)
         elif 0 not in exit_codes:
-            print("All videos failed to download, waiting 60 seconds...")
+            logger.warning('idle', reason='all videos failed to download', wait_seconds=60)
             time.sleep(60)
 
 def test():
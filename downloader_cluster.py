@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+
+WORKERS_DIR = 'workers'
+LEASES_DIR = 'leases'
+CATALOG_DIR = 'catalog'
+CATALOG_NAME = 'catalog.jsonl'
+
+def key_hash(text):
+    return int.from_bytes(hashlib.sha1(text.encode()).digest()[:8], 'big')
+
+def default_worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+def write_json(path: Path, data):
+    '''
+    Atomically replace path, so readers on other hosts never see a partial file
+    '''
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def read_json(path: Path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class HashRing:
+    '''
+    Consistent hash ring with vnodes points per worker. When a worker joins or
+    leaves, only the places on the arcs it gains or loses change owner.
+    '''
+    def __init__(self, workers, vnodes=64):
+        self.points = sorted((key_hash(f'{worker}#{i}'), worker) for worker in workers for i in range(vnodes))
+        self.hashes = [h for h, _ in self.points]
+
+    def owner(self, key):
+        if not self.points:
+            return None
+        i = bisect.bisect(self.hashes, key_hash(key)) % len(self.points)
+        return self.points[i][1]
+
+def heartbeat(cluster_dir: Path, worker_id):
+    path = Path(cluster_dir) / WORKERS_DIR / f'{worker_id}.json'
+    write_json(path, {'worker': worker_id, 'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()})
+
+def live_workers(cluster_dir: Path, lease_seconds, now=None):
+    '''
+    Workers whose heartbeat is younger than lease_seconds
+    '''
+    now = time.time() if now is None else now
+    workers = []
+    for path in sorted((Path(cluster_dir) / WORKERS_DIR).glob('*.json')):
+        data = read_json(path)
+        if data is not None and now - data['time'] < lease_seconds:
+            workers.append(data['worker'])
+    return workers
+
+def lease_files(cluster_dir: Path, place):
+    '''
+    Lease files of a place, <sha1 of place>.<generation>.json
+
+    Returns
+    -------
+    sorted list of (generation, Path)
+    '''
+    prefix = hashlib.sha1(place.encode()).hexdigest()
+    generations = []
+    for path in (Path(cluster_dir) / LEASES_DIR).glob(prefix + '.*.json'):
+        try:
+            generations.append((int(path.name.split('.')[1]), path))
+        except ValueError:
+            pass
+    return sorted(generations)
+
+def acquire_lease(cluster_dir: Path, place, worker_id, lease_seconds, now=None):
+    '''
+    Take or renew the lease on a place. The lease is the newest generation
+    file of the place. A lease held by another worker is only taken over once
+    it has expired, e.g. because that worker died or stopped renewing it after
+    the ring moved the place away.
+
+    Taking a lease creates the next generation with an exclusive create, so of
+    several workers taking over the same expired lease exactly one succeeds.
+    Only the holder rewrites its own generation in place, and only while more
+    than a quarter of the lease is left, so a renewal never races a takeover.
+
+    Returns
+    -------
+    bool whether worker_id holds the lease
+    '''
+    now = time.time() if now is None else now
+    lease = {'place': place, 'worker': worker_id, 'expires': now + lease_seconds}
+    generations = lease_files(cluster_dir, place)
+    if generations:
+        generation, path = generations[-1]
+        current = read_json(path)
+        if current is None:
+            # the next generation is being written by the worker that created it
+            return False
+        if current['worker'] == worker_id and current['expires'] - now > lease_seconds / 4:
+            write_json(path, {**lease, 'generation': generation})
+            return lease_files(cluster_dir, place)[-1][0] == generation
+        if current['worker'] != worker_id and current['expires'] > now:
+            return False
+        generation += 1
+    else:
+        generation = 0
+
+    prefix = hashlib.sha1(place.encode()).hexdigest()
+    path = Path(cluster_dir) / LEASES_DIR / f'{prefix}.{generation}.json'
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump({**lease, 'generation': generation}, f)
+    # a worker acting on an older listing may have created a generation that
+    # was already superseded; only the newest generation holds the lease
+    generations = lease_files(cluster_dir, place)
+    if generations[-1][0] != generation:
+        path.unlink(missing_ok=True)
+        return False
+    for _, old in generations[:-1]:
+        old.unlink(missing_ok=True)
+    return True
+
+def release_lease(cluster_dir: Path, place, worker_id):
+    '''
+    Expire the lease if worker_id holds it, so other workers can take it at once
+    '''
+    generations = lease_files(cluster_dir, place)
+    if not generations:
+        return
+    generation, path = generations[-1]
+    current = read_json(path)
+    if current is not None and current['worker'] == worker_id:
+        write_json(path, {**current, 'expires': 0.0})
+
+class ClusterMember:
+    '''
+    One downloader in a cluster sharing cluster_dir over a shared filesystem
+
+    A background thread writes the worker's heartbeat and renews its place
+    leases every lease_seconds/3. Each cycle, refresh() rebuilds the hash ring
+    from the workers with a live heartbeat; a place is recorded by the worker
+    the ring assigns it to, once that worker holds the place's lease. When a
+    worker dies its heartbeat and leases expire and the ring hands its places
+    to the survivors.
+    '''
+    def __init__(self, cluster_dir: Path, worker_id=None, lease_seconds=120.0, vnodes=64):
+        self.cluster_dir = Path(cluster_dir)
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.vnodes = vnodes
+        self.lock = threading.Lock()
+        self.held = set()
+        self.stopped = threading.Event()
+        for name in (WORKERS_DIR, LEASES_DIR, CATALOG_DIR):
+            (self.cluster_dir / name).mkdir(parents=True, exist_ok=True)
+        heartbeat(self.cluster_dir, self.worker_id)
+        self.ring = HashRing([self.worker_id], vnodes)
+        self.thread = threading.Thread(target=self._renew, daemon=True)
+        self.thread.start()
+
+    def _renew(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            heartbeat(self.cluster_dir, self.worker_id)
+            with self.lock:
+                held = list(self.held)
+            for place in held:
+                if not acquire_lease(self.cluster_dir, place, self.worker_id, self.lease_seconds):
+                    with self.lock:
+                        self.held.discard(place)
+
+    def refresh(self):
+        '''
+        Rebuild the ring from live workers
+
+        Returns
+        -------
+        list of live workers
+        '''
+        heartbeat(self.cluster_dir, self.worker_id)
+        workers = live_workers(self.cluster_dir, self.lease_seconds)
+        if self.worker_id not in workers:
+            workers.append(self.worker_id)
+        self.ring = HashRing(workers, self.vnodes)
+        return workers
+
+    def assigned(self, place):
+        return self.ring.owner(place) == self.worker_id
+
+    def owns(self, place):
+        '''
+        True if the ring assigns place to this worker and it holds the lease
+        '''
+        if not self.assigned(place):
+            return False
+        if not acquire_lease(self.cluster_dir, place, self.worker_id, self.lease_seconds):
+            return False
+        with self.lock:
+            self.held.add(place)
+        return True
+
+    def release_except(self, places):
+        '''
+        Release the leases of held places not in places
+        '''
+        with self.lock:
+            released = self.held - set(places)
+            self.held -= released
+        for place in released:
+            release_lease(self.cluster_dir, place, self.worker_id)
+
+    def record(self, record):
+        '''
+        Append a result to this worker's catalog
+        '''
+        line = json.dumps({'time': time.time(), 'worker': self.worker_id, **record}, default=str)
+        with open(self.cluster_dir / CATALOG_DIR / f'{self.worker_id}.jsonl', 'a') as f:
+            f.write(line + '\n')
+
+    def leave(self):
+        '''
+        Stop renewing, release all leases, and remove the heartbeat so the
+        other workers take over at once
+        '''
+        self.stopped.set()
+        self.thread.join()
+        self.release_except(())
+        (self.cluster_dir / WORKERS_DIR / f'{self.worker_id}.json').unlink(missing_ok=True)
+
+def merge_catalog(cluster_dir: Path):
+    '''
+    Merge the per-worker catalogs into cluster_dir/catalog.jsonl ordered by time
+
+    Returns
+    -------
+    number of records
+    '''
+    records = []
+    for path in sorted((Path(cluster_dir) / CATALOG_DIR).glob('*.jsonl')):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass # partial last line of a worker that is writing or died
+    records.sort(key=lambda r: r['time'])
+    path = Path(cluster_dir) / CATALOG_NAME
+    tmp_path = path.with_suffix('.jsonl.tmp')
+    with open(tmp_path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    os.replace(tmp_path, path)
+    return len(records)
+
+def status(cluster_dir: Path, lease_seconds):
+    now = time.time()
+    workers = live_workers(cluster_dir, lease_seconds, now)
+    newest = {}
+    for path in (Path(cluster_dir) / LEASES_DIR).glob('*.*.json'):
+        prefix, generation = path.name.split('.')[:2]
+        if generation.isdigit() and int(generation) >= newest.get(prefix, (-1, None))[0]:
+            newest[prefix] = (int(generation), path)
+    leases = {}
+    for _, path in newest.values():
+        lease = read_json(path)
+        if lease is not None and lease['expires'] > now:
+            leases[lease['worker']] = leases.get(lease['worker'], 0) + 1
+    return {'workers': {w: leases.get(w, 0) for w in workers},
+            'orphaned_leases': sum(n for w, n in leases.items() if w not in workers)}
+
+def selftest_worker(cluster_dir, worker_id, places, lease_seconds, cycle_seconds, run_seconds):
+    '''
+    Simulated downloader: every cycle, claim owned places and record them
+    '''
+    member = ClusterMember(cluster_dir, worker_id, lease_seconds, vnodes=32)
+    end = time.time() + run_seconds
+    while time.time() < end:
+        member.refresh()
+        owned = [place for place in places if member.owns(place)]
+        member.release_except(owned)
+        for place in owned:
+            member.record({'place': place, 'clip': f'{place}_{int(time.time())}.mp4', 'exit_code': 0})
+        time.sleep(cycle_seconds)
+    member.leave()
+
+def selftest(workers=3, places=60, lease_seconds=2.0, cycle_seconds=0.25, run_seconds=8.0):
+    '''
+    Run workers as local processes on a temporary cluster folder, kill one
+    halfway, and check that every place was recorded, that the dead worker's
+    places were taken over, and that no place was recorded by two workers in
+    the same cycle window
+
+    Returns
+    -------
+    dict of results, 'ok' is True if all checks passed
+    '''
+    import tempfile
+    cluster_dir = Path(tempfile.mkdtemp(prefix='cluster-'))
+    names = [f'Cam{i:04d}' for i in range(places)]
+    ctx = multiprocessing.get_context('spawn')
+    procs = {}
+    for i in range(workers):
+        worker_id = f'worker{i}'
+        procs[worker_id] = ctx.Process(target=selftest_worker, args=(cluster_dir, worker_id, names, lease_seconds, cycle_seconds, run_seconds))
+        procs[worker_id].start()
+
+    time.sleep(run_seconds / 2)
+    killed = 'worker0'
+    procs[killed].kill()
+    killed_at = time.time()
+    for p in procs.values():
+        p.join()
+
+    merge_catalog(cluster_dir)
+    with open(cluster_dir / CATALOG_NAME) as f:
+        records = [json.loads(line) for line in f]
+    killed_places = {r['place'] for r in records if r['worker'] == killed}
+    # after the dead worker's leases expire, its places must be recorded by others
+    takeover = {r['place'] for r in records if r['worker'] != killed and r['time'] > killed_at + lease_seconds}
+    windows = {}
+    for r in records:
+        windows.setdefault((r['place'], int(r['time'] / cycle_seconds)), set()).add(r['worker'])
+    overlaps = sum(len(w) > 1 for w in windows.values())
+    per_worker = {}
+    for r in records:
+        per_worker[r['worker']] = per_worker.get(r['worker'], 0) + 1
+    result = {
+        'cluster_dir': str(cluster_dir),
+        'records': len(records),
+        'records_per_worker': per_worker,
+        'places_recorded': len({r['place'] for r in records}),
+        'killed_worker_places': len(killed_places),
+        'killed_places_taken_over': len(killed_places & takeover),
+        'overlapping_windows': overlaps,
+    }
+    result['ok'] = (result['places_recorded'] == places
+                    and killed_places <= takeover
+                    and overlaps == 0)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='coordinates downloader2.py workers sharing a cluster folder')
+    parser.add_argument('command', choices=('status', 'merge', 'selftest'), help='status: live workers and leases; merge: merge worker catalogs into catalog.jsonl; selftest: run local workers and check failover')
+    parser.add_argument('cluster_dir', nargs='?', default='', help='cluster folder shared by the workers (not needed for selftest)')
+    parser.add_argument('--lease-seconds', type=float, default=120.0, help='heartbeat and lease lifetime the workers use. Default 120.')
+    parser.add_argument('--workers', type=int, default=3, help='selftest: number of worker processes. Default 3.')
+    parser.add_argument('--places', type=int, default=60, help='selftest: number of places. Default 60.')
+    args = parser.parse_args()
+
+    if args.command == 'selftest':
+        result = selftest(args.workers, args.places)
+        print(json.dumps(result, indent=1))
+        if not result['ok']:
+            exit(1)
+        return
+    if args.cluster_dir == '':
+        parser.error(f'{args.command} requires cluster_dir')
+    cluster_dir = Path(args.cluster_dir).expanduser()
+    if args.command == 'status':
+        print(json.dumps(status(cluster_dir, args.lease_seconds), indent=1))
+    else:
+        print(f'merged records: {merge_catalog(cluster_dir)}')
+
+if __name__ == '__main__':
+    main()
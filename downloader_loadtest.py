@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+import argparse
+import functools
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler, SimpleHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+from metrics import configure_logging
+
+# downloader2 reads these at import time
+os.environ.setdefault('API_KEYS', 'loadtest')
+os.environ.setdefault('TEST', 'false')
+
+class FakeWeatherHandler(BaseHTTPRequestHandler):
+    '''
+    Stand-in for api.openweathermap.org/data/2.5/weather. Behaviour is set on
+    the server: latency (min, max) seconds, error_rate, rain_rate, and
+    rate_limit requests per second per API key (0 for none).
+    '''
+    def do_GET(self):
+        server = self.server
+        query = parse_qs(urlparse(self.path).query)
+        api_key = query.get('appid', [''])[0]
+        time.sleep(random.uniform(*server.latency))
+
+        with server.lock:
+            server.requests += 1
+            now = time.time()
+            window = [t for t in server.calls.get(api_key, []) if now - t < 1.0]
+            limited = server.rate_limit > 0 and len(window) >= server.rate_limit
+            if not limited:
+                window.append(now)
+            server.calls[api_key] = window
+            if limited:
+                server.rate_limited += 1
+
+        if limited:
+            self.reply(429, {'cod': 429, 'message': 'rate limited'})
+        elif random.random() < server.error_rate:
+            with server.lock:
+                server.errors += 1
+            self.reply(500, {'cod': 500, 'message': 'internal error'})
+        else:
+            main = 'Rain' if random.random() < server.rain_rate else 'Clouds'
+            self.reply(200, {
+                'coord': {'lat': float(query['lat'][0]), 'lon': float(query['lon'][0])},
+                'weather': [{'main': main}]})
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+def start_weather_server(latency=(0.05, 0.2), error_rate=0.0, rain_rate=0.5, rate_limit=0):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeWeatherHandler)
+    server.latency = latency
+    server.error_rate = error_rate
+    server.rain_rate = rain_rate
+    server.rate_limit = rate_limit
+    server.lock = threading.Lock()
+    server.calls = {}
+    server.requests = server.errors = server.rate_limited = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class QuietFileHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def start_hls_server(directory: Path, seconds=30, size='320x180', fps=10):
+    '''
+    Generate a test pattern HLS stream with ffmpeg and serve it over HTTP
+
+    Returns
+    -------
+    server AND URL of the manifest
+    '''
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc=size={size}:rate={fps}',
+        '-t', str(seconds),
+        '-c:v', 'libx264', '-g', str(fps),
+        '-f', 'hls', '-hls_time', '2', '-hls_list_size', '0', '-hls_playlist_type', 'vod',
+        str(directory / 'stream.m3u8')], check=True)
+    handler = functools.partial(QuietFileHandler, directory=str(directory))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/stream.m3u8'
+
+class FileWorksheet:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get_all_values(self):
+        return self.rows
+
+class FileSpreadsheet:
+    '''
+    File-backed stand-in for the parts of gspread.Spreadsheet used by
+    downloader2.find_places. The file is JSON mapping region titles to rows,
+    the first row being the header: City | Latitude | Longitude | Link.
+    '''
+    def __init__(self, path: Path):
+        with open(path) as f:
+            self.regions = list(json.load(f).items())
+
+    def fetch_sheet_metadata(self):
+        return {'sheets': [{'properties': {'title': title}} for title, _ in self.regions]}
+
+    def get_worksheet(self, i):
+        return FileWorksheet(self.regions[i][1])
+
+def generate_sheet(path: Path, webcams, link, regions=5, seed=0):
+    '''
+    Write a FileSpreadsheet JSON file with webcams spread over regions
+    '''
+    rng = random.Random(seed)
+    sheet = {}
+    for i in range(webcams):
+        rows = sheet.setdefault(f'Region_{i % regions}', [['City', 'Latitude', 'Longitude', 'Link']])
+        rows.append([f'Cam{i:04d}', f'{rng.uniform(-60, 60):.4f}', f'{rng.uniform(-180, 180):.4f}', link])
+    with open(path, 'w') as f:
+        json.dump(sheet, f)
+
+def usage_delta(before, after):
+    return {
+        'user_seconds': after.ru_utime - before.ru_utime,
+        'system_seconds': after.ru_stime - before.ru_stime,
+        'max_rss_kb': after.ru_maxrss,
+    }
+
+def run_cycles(downloader2, spreadsheet, cycles, seconds, work_dir: Path, timeout=True, quiet=True):
+    '''
+    Run find_places and download like downloader2.main does, measuring each
+    cycle. The downloader's log records go to stderr, only warnings and errors
+    when quiet, so they stay out of the JSON report on stdout.
+
+    Returns
+    -------
+    list of per-cycle metrics
+    '''
+    spawn_times = []
+    start_recording = downloader2.start_recording
+    @functools.wraps(start_recording)
+    def timed_start_recording(*args, **kwargs):
+        result = start_recording(*args, **kwargs)
+        spawn_times.append(time.time())
+        return result
+    downloader2.start_recording = timed_start_recording
+
+    configure_logging(level=logging.WARNING if quiet else logging.INFO, stream=sys.stderr)
+    results = []
+    try:
+        for cycle in range(cycles):
+            self_before = resource.getrusage(resource.RUSAGE_SELF)
+            children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            start = time.time()
+            places = downloader2.find_places(spreadsheet, daytime=False)
+            scan = time.time() - start
+
+            spawn_times.clear()
+            start = time.time()
+            exit_codes, _ = downloader2.download(
+                places,
+                seconds=seconds,
+                tmp_dir=work_dir / 'tmp',
+                final_dir=work_dir / 'downloads',
+                timeout=timeout)
+            capture = time.time() - start
+            results.append({
+                'cycle': cycle,
+                'scan_seconds': scan,
+                'places': len(places),
+                'first_start_seconds': spawn_times[0] - start if spawn_times else None,
+                'start_skew_seconds': spawn_times[-1] - spawn_times[0] if spawn_times else None,
+                'capture_seconds': capture,
+                'captures': len(exit_codes),
+                'successes': exit_codes.count(0),
+                'success_rate': exit_codes.count(0) / len(exit_codes) if exit_codes else None,
+                'self': usage_delta(self_before, resource.getrusage(resource.RUSAGE_SELF)),
+                'children': usage_delta(children_before, resource.getrusage(resource.RUSAGE_CHILDREN)),
+            })
+            print(f"cycle {cycle}: scan {scan:.2f}s, {len(places)} places, "
+                  f"{exit_codes.count(0)}/{len(exit_codes)} captured", file=sys.stderr)
+    finally:
+        downloader2.start_recording = start_recording
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='load tests downloader2 offline against local weather, sheet, and HLS stand-ins')
+    parser.add_argument('-w', '--webcams', type=int, default=100, help='number of webcams in the generated sheet. Default 100.')
+    parser.add_argument('-c', '--cycles', type=int, default=3, help='number of find_places + download cycles. Default 3.')
+    parser.add_argument('-s', '--seconds', type=int, default=5, help='length of each recording in seconds. Default 5.')
+    parser.add_argument('--sheet', type=str, default='', help='FileSpreadsheet JSON to use instead of a generated sheet')
+    parser.add_argument('--latency', type=str, default='0.05,0.2', help='weather API latency range in seconds: MIN,MAX. Default 0.05,0.2')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of weather requests answered with HTTP 500. Default 0.')
+    parser.add_argument('--rain-rate', type=float, default=0.5, help='fraction of weather responses reporting rain. Default 0.5.')
+    parser.add_argument('--rate-limit', type=int, default=0, help='weather requests per second per API key before HTTP 429, 0 for none. Default 0.')
+    parser.add_argument('--api-keys', type=int, default=1, help='number of fake API keys. Default 1.')
+    parser.add_argument('-o', '--output', type=str, default='', help='file to write the JSON report to. Default: stdout')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='show the downloader\'s INFO log records, not only warnings and errors')
+    args = parser.parse_args()
+
+    import downloader2
+
+    work_dir = Path(tempfile.mkdtemp(prefix='loadtest-'))
+    try:
+        latency = tuple(float(t) for t in args.latency.split(','))
+        weather_server = start_weather_server(latency, args.error_rate, args.rain_rate, args.rate_limit)
+        downloader2.WEATHER_URL = f'http://127.0.0.1:{weather_server.server_address[1]}/data/2.5/weather'
+        downloader2.API_KEYS = [f'key{i}' for i in range(args.api_keys)]
+
+        (work_dir / 'hls').mkdir()
+        hls_server, link = start_hls_server(work_dir / 'hls', seconds=max(30, 2*args.seconds))
+        sheet_path = Path(args.sheet) if args.sheet else work_dir / 'sheet.json'
+        if not args.sheet:
+            generate_sheet(sheet_path, args.webcams, link)
+
+        cycles = run_cycles(downloader2, FileSpreadsheet(sheet_path), args.cycles, args.seconds, work_dir, quiet=not args.verbose)
+        report = {
+            'webcams': args.webcams,
+            'seconds': args.seconds,
+            'weather': {
+                'latency': latency,
+                'error_rate': args.error_rate,
+                'rain_rate': args.rain_rate,
+                'rate_limit': args.rate_limit,
+                'requests': weather_server.requests,
+                'errors': weather_server.errors,
+                'rate_limited': weather_server.rate_limited,
+            },
+            'cycles': cycles,
+        }
+        weather_server.shutdown()
+        hls_server.shutdown()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,17 @@ import numpy as np
 import os
 import cv2
 import argparse
-import matplotlib.pyplot as plt
 import sys
+import subprocess
+import hashlib
+import json
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from clips import find_videos
+
+
+# --early-exit checks the decision after this many frames, then every 1.5x as many
+EARLY_EXIT_MIN_FRAMES = 60
 
 def mod_z(col: np.array, thresh: float=3.5) -> np.array:
     '''
@@ -30,9 +39,128 @@ def is_rainy_pixel_temporal(intensities, frame_count, thresh):
     rainy = True if percent_outliers >= thresh else False
     return rainy, mu, sigma, outliers, percent_outliers
 
-def is_rainy_video(cap: cv2.VideoCapture, seq_len: int, thresh: float=2, window=(2,2), show_figs: bool=False, bins: int=15) -> bool:
+def temporal_pixel_stats(intensities: np.array, thresh: float=3.5, chunk: int=1<<16):
+    '''
+    Vectorized is_rainy_pixel_temporal statistics for every column of a
+    (frames x pixels) matrix, computed along axis 0 in chunks of columns to
+    bound the size of the float temporaries.
+
+    Returns
+    -------
+    arrays of length pixels: mean, std, outlier count, percent outliers
+    '''
+    frame_count, pixels = intensities.shape
+    mu = np.empty(pixels)
+    sigma = np.empty(pixels)
+    outliers = np.empty(pixels, dtype=np.int64)
+    for start in range(0, pixels, chunk):
+        cols = slice(start, min(start + chunk, pixels))
+        block = intensities[:, cols]
+        mu[cols] = np.mean(block, axis=0)
+        sigma[cols] = np.std(block, axis=0)
+
+        # modified z-scores; a zero MAD makes every score inf/nan, which
+        # counts as an outlier just like in mod_z
+        med = np.median(block, axis=0)
+        dev = block - med
+        med_abs_dev = np.median(np.abs(dev), axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mz = 0.7413 * (dev / med_abs_dev)
+        outliers[cols] = frame_count - np.count_nonzero(np.abs(mz) < thresh, axis=0)
+    percent_outliers = outliers / frame_count * 100
+    return mu, sigma, outliers, percent_outliers
+
+def vote_rainy(mu, sigma, outliers, percent_outliers, frame_count, thresh):
+    '''
+    Majority vote over pixels. Returns the decision together with the
+    statistics of the first pixel that agrees with the majority.
+    '''
+    voting = percent_outliers >= thresh
+    rainy = bool(np.count_nonzero(voting) >= np.count_nonzero(~voting))
+    i = np.flatnonzero(voting == rainy)[0]
+    return rainy, mu[i], sigma[i], int(outliers[i]), frame_count, percent_outliers[i]
+
+def decision_settled(percent_outliers: np.array, samples: int, thresh: float, z: float=3.0) -> bool:
+    '''
+    True once the majority vote can no longer change: enough pixels are further
+    than z binomial standard errors from the threshold on the same side that
+    the undecided pixels cannot flip the outcome.
+    '''
+    p = percent_outliers / 100
+    t = thresh / 100
+    se = np.sqrt(np.maximum(p * (1 - p), 1 / samples) / samples)
+    pixels = len(p)
+    rainy = np.count_nonzero(p - t > z * se)
+    clear = np.count_nonzero(t - p > z * se)
+    return rainy >= pixels - rainy or clear > pixels - clear
+
+def read_window_opencv(cap: cv2.VideoCapture, frame_count: int, rows: slice, cols: slice, stride: int=1, size=None):
+    '''
+    Yields the flattened grayscale window of every stride-th frame among the
+    first frame_count frames. Skipped frames are only grabbed, and only the
+    window is converted to grayscale.
+
+    size : Tuple[int, int], Default: None
+        (width, height) to resize frames to before taking the window
+    '''
+    for i in range(frame_count):
+        if i % stride:
+            cap.grab()
+            continue
+        ret, frame = cap.read()
+        if not ret:
+            return
+        if size is not None:
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        roi = np.ascontiguousarray(frame[rows, cols])
+        yield cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY).reshape(-1)
+
+def read_window_ffmpeg(video_path, frame_count: int, rows: slice, cols: slice, stride: int=1, size=None):
+    '''
+    Same as read_window_opencv, but frame selection, resizing, cropping to the
+    window, and grayscale conversion all happen inside an ffmpeg process whose
+    raw output is read from a pipe.
+    '''
+    filters = []
+    if stride > 1:
+        filters.append(f'select=not(mod(n\\,{stride}))')
+    if size is not None:
+        filters.append(f'scale={size[0]}:{size[1]}:flags=area')
+    out_w, out_h = cols.stop - cols.start, rows.stop - rows.start
+    filters.append(f'crop={out_w}:{out_h}:{cols.start}:{rows.start}')
+    ffmpeg_args = [
+        'ffmpeg',
+        '-v', 'error',
+        '-nostdin',
+        '-i', str(video_path),
+        '-an',                     # discard audio
+        '-vf', ','.join(filters),
+        '-vsync', '0',             # keep only the selected frames
+        '-frames:v', str(-(-frame_count // stride)),
+        '-pix_fmt', 'gray',
+        '-f', 'rawvideo',
+        '-']
+    p = subprocess.Popen(ffmpeg_args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    frame_bytes = out_w * out_h
+    try:
+        while True:
+            buf = p.stdout.read(frame_bytes)
+            if len(buf) < frame_bytes:
+                return
+            yield np.frombuffer(buf, dtype=np.uint8)
+    finally:
+        p.kill()
+        p.wait()
+
+def window_intensities(cap: cv2.VideoCapture, seq_len: int, thresh: float=2, window=(2,2),
+                       stride: int=1, early_exit: bool=False, decode: str='opencv', scale: int=1, video_path=None) -> np.array:
     '''
-    NOTE: if seq_len is negative, all frames will be used
+    Grayscale intensities of the window pixels over time, see is_rainy_video
+    for the parameters. thresh is only used by early_exit.
+
+    Returns
+    -------
+    uint8 array of shape (frames analysed, window pixels)
     '''
     # determine properties of video
     frame_count_total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
@@ -41,36 +169,70 @@ def is_rainy_video(cap: cv2.VideoCapture, seq_len: int, thresh: float=2, window=
         frame_count = frame_count_total
     w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    size = None
+    if scale > 1:
+        w, h = max(1, w // scale), max(1, h // scale)
+        size = (w, h)
     w_mid = w // 2
     h_mid = h // 2
 
     # extract window properties
     windw = window[0]
     windh = window[1]
-    window_pixels_per_image = windw * windh
+    if windw <= 0 or windh <= 0:
+        rows, cols = slice(0, h), slice(0, w)
+        window_pixels_per_image = w * h
+    else:
+        rows, cols = slice(w_mid, w_mid+windw), slice(h_mid, h_mid+windh)
+        window_pixels_per_image = windw * windh
 
     # extract intensities of middle pixel
-    intensities = np.zeros((frame_count, window_pixels_per_image))
+    if decode == 'ffmpeg':
+        samples = read_window_ffmpeg(video_path, frame_count, rows, cols, stride, size)
+    else:
+        samples = read_window_opencv(cap, frame_count, rows, cols, stride, size)
+    intensities = np.zeros((-(-frame_count // stride), window_pixels_per_image), dtype=np.uint8)
+    n = 0
+    next_check = EARLY_EXIT_MIN_FRAMES
+    for pixels in samples:
+        intensities[n] = pixels
+        n += 1
+        if early_exit and n == next_check and n < len(intensities):
+            next_check = int(n * 1.5)
+            if decision_settled(temporal_pixel_stats(intensities[:n])[3], n, thresh):
+                break
+    samples.close()
+    return intensities[:n]
 
-    for i in range(frame_count):
-        _, frame = cap.read()
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        intensities[i] = frame[w_mid:w_mid+windw, h_mid:h_mid+windh].flatten()
+def is_rainy_video(cap: cv2.VideoCapture, seq_len: int, thresh: float=2, window=(2,2), show_figs: bool=False, bins: int=15,
+                   stride: int=1, early_exit: bool=False, decode: str='opencv', scale: int=1, video_path=None) -> bool:
+    '''
+    NOTE: if seq_len is negative, all frames will be used. A window of (0, 0)
+    uses every pixel of the frame.
+
+    stride : int, Default: 1
+        use every stride-th of the first seq_len frames
+
+    early_exit : bool, Default: False
+        stop reading once decision_settled says more frames cannot change the vote
+
+    decode : str, Default: opencv
+        'opencv' decodes through cap, 'ffmpeg' decodes video_path through an ffmpeg pipe
+
+    scale : int, Default: 1
+        divide the frame width and height by scale before taking the window
+
+    The returned frame count is the number of frames actually analysed.
+    '''
+    intensities = window_intensities(cap, seq_len, thresh, window, stride, early_exit, decode, scale, video_path)
+    frame_count = len(intensities)
 
     # determine whether rainy from each pixel
-    voting = np.zeros(window_pixels_per_image)
-    for i in range(window_pixels_per_image):
-        voting[i] = is_rainy_pixel_temporal(intensities[:,i], frame_count, thresh)[0]
-    
-    rainy = False
-    if len(voting[voting==True]) >= len(voting[voting==False]):
-        rainy = True
-
-    # extract information of a temporal set of pixels with majority vote
-    i = np.where(voting == rainy)[0][0]
-    _, mu, sigma, outliers, percent_outliers = is_rainy_pixel_temporal(intensities[:,i], frame_count, thresh)
+    mu, sigma, outliers, percent_outliers = temporal_pixel_stats(intensities)
+    rainy, mu, sigma, outliers, frame_count, percent_outliers = vote_rainy(mu, sigma, outliers, percent_outliers, frame_count, thresh)
 
     if show_figs:
+        import matplotlib.pyplot as plt
         plt.hist(intensities, bins=bins, color='b')
         plt.plot(mu, 0, 'ro')
         plt.plot([mu-sigma, mu+sigma], [0,0], 'o', color="orange")
@@ -78,28 +240,117 @@ def is_rainy_video(cap: cv2.VideoCapture, seq_len: int, thresh: float=2, window=
 
     return rainy, mu, sigma, outliers, frame_count, percent_outliers
 
+def cache_path(cache_dir, video_path, frames: int, threshold: float, window, stride: int=1, early_exit: bool=False, decode: str='opencv', scale: int=1):
+    '''
+    Location of the cached per-pixel statistics for a video. The key covers the
+    file identity (path, size, mtime) and every option that changes which
+    pixels and frames are read. The threshold only affects the statistics when
+    early_exit is used, so otherwise changing it reuses the cache.
+    '''
+    st = os.stat(video_path)
+    key = [os.path.abspath(video_path), st.st_size, st.st_mtime_ns, frames, list(window), stride, decode, scale]
+    if early_exit:
+        key.append(threshold)
+    digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+    return os.path.join(cache_dir, digest + '.npz')
+
+def load_cached_stats(path):
+    '''
+    Returns
+    -------
+    mean, std, outlier count, percent outliers, frame count; or None if not cached
+    '''
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        frame_count = int(data['frame_count'])
+        outliers = data['outliers']
+        return data['mu'], data['sigma'], outliers, outliers / frame_count * 100, frame_count
+
+def save_cached_stats(path, mu, sigma, outliers, frame_count):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, mu=mu, sigma=sigma, outliers=outliers, frame_count=frame_count)
+    os.replace(tmp_path, path)
+
+def classify_file(path, frames: int, threshold: float, window, plot_bool: bool=False, bins: int=15, cache_dir=None, **decode_options):
+    '''
+    Runs is_rainy_video on the video at path. decode_options are passed on to
+    is_rainy_video (stride, early_exit, decode, scale).
+
+    If cache_dir is given, the per-pixel statistics are stored there and reused
+    on later runs, so only the vote is redone when just the threshold changes.
+
+    Returns
+    -------
+    is_rainy_video results, or None if the file has no frames
+    '''
+    if cache_dir is not None and not plot_bool:
+        stats_path = cache_path(cache_dir, path, frames, threshold, window, **decode_options)
+        stats = load_cached_stats(stats_path)
+        if stats is not None:
+            return vote_rainy(*stats, threshold)
+
+    cap = cv2.VideoCapture(path)
+    if (int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) == 0):
+        return None
+    if cache_dir is None or plot_bool:
+        return is_rainy_video(cap, frames, threshold, window, plot_bool, bins, video_path=path, **decode_options)
+
+    intensities = window_intensities(cap, frames, threshold, window, video_path=path, **decode_options)
+    mu, sigma, outliers, percent_outliers = temporal_pixel_stats(intensities)
+    save_cached_stats(stats_path, mu, sigma, outliers, len(intensities))
+    return vote_rainy(mu, sigma, outliers, percent_outliers, len(intensities), threshold)
+
+def classify_files(folder, files, frames: int, threshold: float, window, plot_bool: bool=False, bins: int=15, jobs: int=1, cache_dir=None, **decode_options):
+    '''
+    Yields (file, classify_file result) in the order of files. With jobs > 1
+    the videos are classified in a process pool and results are yielded as
+    soon as every earlier file has finished.
+    '''
+    paths = [os.path.join(folder, file) for file in files]
+    if jobs == 1:
+        for file, path in zip(files, paths):
+            yield file, classify_file(path, frames, threshold, window, plot_bool, bins, cache_dir, **decode_options)
+        return
+    job = partial(classify_file, frames=frames, threshold=threshold, window=window, bins=bins, cache_dir=cache_dir, **decode_options)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from zip(files, pool.map(job, paths))
+
 def main():
     parser = argparse.ArgumentParser(description='filters rainy and non-rainy videos')
     parser.add_argument('folder', help='folder with videos')
     parser.add_argument('-f', '--frames', type=int, default=-1, help='frames to process, defaults to all frames')
     parser.add_argument('-t', '--threshold', type=float, default=2.0, help='threshold for the percentage of outliers to be considered rain drops, default is 2.0 (e.g. 2.0%%)')
-    parser.add_argument('-w', '--window', metavar='n', type=int, default=2, help='nxn window of pixels in center of image to process. Default is 2x2.')
+    parser.add_argument('-w', '--window', metavar='n', type=int, default=2, help='nxn window of pixels in center of image to process. 0 uses the full frame. Default is 2x2.')
     parser.add_argument('--plot', dest='plot_bool', default=False, action='store_true', help='displays plots of the histogram of intensities for each video')
     parser.add_argument('-b', '--bins', type=int, default=15, help='number of bins to display in the histogram plots')
     parser.add_argument('--csv', default=False, action='store_true', help='output csv format')
+    parser.add_argument('-r', '--recursive', default=False, action='store_true', help='also process videos in subfolders, e.g. <date>/<weather>/')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of videos to process in parallel, ignored with --plot. Default is 1.')
+    parser.add_argument('-k', '--stride', type=int, default=1, help='use every k-th frame. Default is 1.')
+    parser.add_argument('--early-exit', default=False, action='store_true', help='stop decoding once more frames cannot change the decision')
+    parser.add_argument('--decode', type=str, default='opencv', choices=('opencv', 'ffmpeg'), help='decoder, ffmpeg crops and converts inside an ffmpeg pipe. Default is opencv.')
+    parser.add_argument('--scale', type=int, default=1, help='divide the frame resolution by this factor before taking the window. Default is 1.')
+    parser.add_argument('--cache', type=str, default='.filter_cache', help='folder caching per-pixel statistics so that changing only --threshold does not decode again. Default is ./.filter_cache')
+    parser.add_argument('--no-cache', default=False, action='store_true', help='do not read or write the cache')
     args = parser.parse_args()
     folder, plot_bool, frames, threshold, n, bins, csv_bool = args.folder, args.plot_bool, args.frames, args.threshold, args.window, args.bins, args.csv
     window = (n, n)
+    jobs = 1 if plot_bool else max(1, args.jobs)
+    cache_dir = None if args.no_cache else args.cache
+    decode_options = {'stride': max(1, args.stride), 'early_exit': args.early_exit, 'decode': args.decode, 'scale': max(1, args.scale)}
 
     if csv_bool:
         print('file,rainy,mean,std,outlier count,total intensities,percent outliers,window')
 
-    for file in sorted(os.listdir(folder)):
+    files = find_videos(folder, args.recursive)
+    for file, result in classify_files(folder, files, frames, threshold, window, plot_bool, bins, jobs, cache_dir, **decode_options):
         print(f"processing {file}", file=sys.stderr)
-        cap = cv2.VideoCapture(os.path.join(folder, file))
-        if (int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) == 0):
+        if result is None:
             continue
-        rainy, mu, sigma, outliers, total_intensities, percent_outliers = is_rainy_video(cap, frames, threshold, window, plot_bool, bins)
+        rainy, mu, sigma, outliers, total_intensities, percent_outliers = result
         if not csv_bool:
             print(f"\tnumber of outliers: {outliers}, total number of intensities: {total_intensities}, percent outliers: {percent_outliers:.2f}")
             print(f"\tmean: {mu:.2f}, std: {sigma:.2f}")
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import os
+import sys
+from pathlib import Path
+import numpy as np
+from clips import find_videos, parse_clip_name
+
+INDEX_NAME = 'fingerprints.json'
+
+def dhash(gray, hash_size=8):
+    '''
+    Difference hash of a grayscale image as a python int of hash_size**2 bits
+    '''
+    import cv2
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(''.join('1' if b else '0' for b in bits), 2)
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def clip_fingerprint(video_path, samples=8, size=(64, 36), frozen_motion=0.5):
+    '''
+    Compact fingerprint of a clip from evenly spaced sampled frames
+
+    Parameters
+    ----------
+    video_path : str or Path
+        video to fingerprint
+
+    samples : int, Default: 8
+        number of frames to sample
+
+    size : Tuple[int, int], Default: (64, 36)
+        (width, height) sampled frames are reduced to
+
+    frozen_motion : float, Default: 0.5
+        a clip is frozen if the mean absolute difference between consecutive
+        sampled frames never exceeds this
+
+    Returns
+    -------
+    dict with 'clip_hash' (dHash of the mean frame), 'frame_hashes' (dHash of
+    each sampled frame), 'motion' (temporal difference energy) and 'frozen';
+    None if the video has no frames
+    '''
+    import cv2 # only needed for fingerprinting, not for reading the index
+    cap = cv2.VideoCapture(str(video_path))
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if frame_count == 0:
+        return None
+    positions = set(np.linspace(0, frame_count - 1, min(samples, frame_count)).astype(int).tolist())
+    frames = []
+    for i in range(max(positions) + 1):
+        if i not in positions:
+            cap.grab()
+            continue
+        ret, frame = cap.read()
+        if not ret:
+            break
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        frames.append(cv2.resize(gray, size, interpolation=cv2.INTER_AREA))
+    if len(frames) == 0:
+        return None
+    frames = np.stack(frames)
+
+    motion = 0.0
+    if len(frames) > 1:
+        motion = float(np.abs(np.diff(frames.astype(np.int16), axis=0)).mean(axis=(1, 2)).max())
+    return {
+        'clip_hash': dhash(frames.mean(axis=0).astype(np.uint8)),
+        'frame_hashes': [dhash(f) for f in frames],
+        'motion': motion,
+        'frozen': motion <= frozen_motion,
+    }
+
+class BKTree:
+    '''
+    Burkhard-Keller tree over Hamming distance. Radius queries only descend
+    into children whose edge distance is within the radius of the query's
+    distance to the node, so lookups visit a small part of the index.
+    '''
+    def __init__(self):
+        self.root = None
+
+    def add(self, h, item):
+        if self.root is None:
+            self.root = (h, item, {})
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            if d not in node[2]:
+                node[2][d] = (h, item, {})
+                return
+            node = node[2][d]
+
+    def search(self, h, radius):
+        '''
+        Returns
+        -------
+        list of (distance, item) within radius of h
+        '''
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_hash, item, children = stack.pop()
+            d = hamming(h, node_hash)
+            if d <= radius:
+                found.append((d, item))
+            for edge, child in children.items():
+                if d - radius <= edge <= d + radius:
+                    stack.append(child)
+        return found
+
+def load_index(folder: Path):
+    '''
+    Returns
+    -------
+    dict keyed by video path relative to folder, see update_index
+    '''
+    path = Path(folder) / INDEX_NAME
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_index(folder: Path, index):
+    path = Path(folder) / INDEX_NAME
+    tmp_path = path.with_suffix('.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+
+def build_tree(index):
+    tree = BKTree()
+    for file, entry in index.items():
+        if entry.get('clip_hash') is not None:
+            tree.add(entry['clip_hash'], file)
+    return tree
+
+def find_duplicate(index, tree, file, fingerprint, radius=4):
+    '''
+    Earlier clip of the same place whose sampled frames all lie within radius
+    of this clip's, or None. The BK-tree narrows candidates by the mean-frame
+    hash before the frame sequences are compared.
+    '''
+    place, _ = parse_clip_name(file)
+    for _, other in sorted(tree.search(fingerprint['clip_hash'], radius)):
+        if other == file or parse_clip_name(other)[0] != place:
+            continue
+        other_hashes = index[other]['frame_hashes']
+        if len(other_hashes) != len(fingerprint['frame_hashes']):
+            continue
+        if all(hamming(a, b) <= radius for a, b in zip(other_hashes, fingerprint['frame_hashes'])):
+            return other
+    return None
+
+def update_index(folder: Path, index, radius=4, **fingerprint_options):
+    '''
+    Fingerprints videos under folder that are new or changed since they were
+    indexed, and flags frozen clips and near-duplicates of earlier clips.
+
+    Each entry holds size, mtime_ns, place, clip_hash, frame_hashes, motion,
+    frozen, and duplicate_of (relative path or None).
+
+    Entries of clips no longer under folder are dropped, so deleted or evicted
+    clips are no longer duplicate candidates or counted by frozen_places. A
+    clip moved within folder, e.g. into verified/ or rejected/ by downloader2
+    --verify, is recognized by its name, size, and mtime and keeps its
+    fingerprint under the new path.
+    '''
+    files = sorted(find_videos(folder, recursive=True), key=lambda f: (parse_clip_name(f)[1] or datetime.datetime.min, f))
+    present = set(files)
+    stale = {file: index.pop(file) for file in list(index) if file not in present}
+    stale_keys = {(Path(file).name, e['size'], e['mtime_ns']): file for file, e in stale.items()}
+    moved = {}
+    for file in files:
+        if file in index:
+            continue
+        st = os.stat(Path(folder) / file)
+        old = stale_keys.pop((Path(file).name, st.st_size, st.st_mtime_ns), None)
+        if old is not None:
+            moved[old] = file
+            index[file] = stale[old]
+    for entry in index.values():
+        if entry['duplicate_of'] in moved:
+            entry['duplicate_of'] = moved[entry['duplicate_of']]
+        elif entry['duplicate_of'] in stale:
+            # the earlier copy is gone, so this clip is no longer a duplicate
+            entry['duplicate_of'] = None
+
+    tree = build_tree(index)
+    for file in files:
+        st = os.stat(Path(folder) / file)
+        entry = index.get(file)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            continue
+        print(f"fingerprinting {file}", file=sys.stderr)
+        fingerprint = clip_fingerprint(Path(folder) / file, **fingerprint_options)
+        entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'place': parse_clip_name(file)[0]}
+        if fingerprint is None:
+            entry.update({'clip_hash': None, 'frame_hashes': [], 'motion': 0.0, 'frozen': True, 'duplicate_of': None})
+        else:
+            entry.update(fingerprint)
+            entry['duplicate_of'] = find_duplicate(index, tree, file, fingerprint, radius)
+            tree.add(fingerprint['clip_hash'], file)
+        index[file] = entry
+    return index
+
+def flagged_clips(index):
+    '''
+    Relative paths of clips that are frozen or duplicates
+    '''
+    return {file for file, entry in index.items() if entry['frozen'] or entry['duplicate_of'] is not None}
+
+def latest_clips(index):
+    '''
+    Returns
+    -------
+    dict mapping each place to the time and index entry of its most recent clip
+    '''
+    latest = {}
+    for file, entry in index.items():
+        place, time = parse_clip_name(file)
+        if place is None:
+            continue
+        if place not in latest or time > latest[place][0]:
+            latest[place] = (time, entry)
+    return latest
+
+def frozen_places(index, max_age_hours=6.0, now=None):
+    '''
+    Places whose most recent indexed clip is frozen and less than max_age_hours
+    old. The downloader skips these until the frozen clip ages out, at which
+    point the place is recorded again to check whether the stream recovered.
+    '''
+    now = datetime.datetime.utcnow() if now is None else now
+    return {place for place, (time, entry) in latest_clips(index).items()
+            if entry['frozen'] and now - time < datetime.timedelta(hours=max_age_hours)}
+
+def looping_places(index, max_age_hours=6.0, now=None):
+    '''
+    Places whose most recent indexed clip is a duplicate of an earlier clip
+    (e.g. a webcam replaying a recorded loop) and less than max_age_hours old.
+    Skipped by the downloader like frozen_places.
+    '''
+    now = datetime.datetime.utcnow() if now is None else now
+    return {place for place, (time, entry) in latest_clips(index).items()
+            if entry['duplicate_of'] is not None and now - time < datetime.timedelta(hours=max_age_hours)}
+
+def main():
+    parser = argparse.ArgumentParser(description='fingerprints downloaded videos to find frozen streams and duplicate clips')
+    parser.add_argument('folder', help='downloads folder, the index is stored in it as ' + INDEX_NAME)
+    parser.add_argument('-r', '--radius', type=int, default=4, help='maximum Hamming distance between dHashes of duplicate clips. Default 4.')
+    parser.add_argument('-s', '--samples', type=int, default=8, help='number of frames sampled per clip. Default 8.')
+    parser.add_argument('--frozen-motion', type=float, default=0.5, help='mean absolute difference between sampled frames at or below which a clip is frozen. Default 0.5.')
+    parser.add_argument('--list', default=False, action='store_true', help='print flagged clips')
+    args = parser.parse_args()
+    folder = Path(args.folder).expanduser()
+
+    index = load_index(folder)
+    index = update_index(folder, index, radius=args.radius, samples=args.samples, frozen_motion=args.frozen_motion)
+    save_index(folder, index)
+
+    flagged = flagged_clips(index)
+    print(f'indexed clips: {len(index)}, frozen: {sum(e["frozen"] for e in index.values())}, '
+          f'duplicates: {sum(e["duplicate_of"] is not None for e in index.values())}')
+    if args.list:
+        for file in sorted(flagged):
+            entry = index[file]
+            reason = 'frozen' if entry['frozen'] else f'duplicate of {entry["duplicate_of"]}'
+            print(f'{file},{reason}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+from processor_manifest import file_identity
+
+HEADER_NAME = 'header.json'
+FRAMES_NAME = 'frames.npy'
+CLEAN_NAME = 'clean.npy'
+
+# scene fields that change the decoded frames; sparsity and name do not
+DECODE_FIELDS = ('l', 'r', 't', 'b', 'start_frame', 'num_frames', 'seconds', 'clean_frame')
+
+def source_hash(scene):
+    '''
+    Hash of the rainy and clean video identities and every scene field that
+    changes which pixels are decoded
+    '''
+    key = {
+        'rainy_video': [str(scene['rainy_video_path']), file_identity(scene['rainy_video_path'])],
+        'clean_video': [str(scene['clean_video_path']), file_identity(scene['clean_video_path'])],
+        'fields': {k: scene[k] for k in DECODE_FIELDS},
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def scene_dir(store: Path, scene):
+    return Path(store) / scene['name']
+
+def write_scene(store: Path, scene, frames, clean_frame, fps):
+    '''
+    Write a scene's decoded clip and its clean frame as .npy files
+    with a JSON header. The header is written last, so a scene without one is
+    incomplete and is decoded again.
+
+    Returns
+    -------
+    Path of the scene's folder in the store
+    '''
+    directory = scene_dir(store, scene)
+    if directory.exists():
+        shutil.rmtree(directory)
+    directory.mkdir(parents=True)
+
+    stored = np.lib.format.open_memmap(directory / FRAMES_NAME, mode='w+', dtype=np.uint8, shape=frames.shape)
+    stored[:] = frames
+    stored.flush()
+    del stored
+    np.save(directory / CLEAN_NAME, np.asarray(clean_frame, dtype=np.uint8))
+
+    header = {
+        'shape': list(frames.shape),
+        'fps': fps,
+        'crop': {k: scene[k] for k in ('l', 'r', 't', 'b')},
+        'source_hash': source_hash(scene),
+    }
+    tmp_path = directory / (HEADER_NAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp_path, directory / HEADER_NAME)
+    return directory
+
+def read_header(store: Path, scene):
+    '''
+    Returns
+    -------
+    header dict of the stored scene, or None if the scene is missing,
+    incomplete, or was decoded from different videos or scene fields
+    '''
+    path = scene_dir(store, scene) / HEADER_NAME
+    if not path.exists():
+        return None
+    with open(path) as f:
+        header = json.load(f)
+    if header['source_hash'] != source_hash(scene):
+        return None
+    return header
+
+def open_scene(store: Path, scene):
+    '''
+    Map a stored scene read-only
+
+    Returns
+    -------
+    frames (uint8 memmap (N, H, W, 3)) AND clean frame (uint8 (H, W, 3)); or
+    None if the store has no valid copy
+    '''
+    header = read_header(store, scene)
+    if header is None:
+        return None
+    directory = scene_dir(store, scene)
+    frames = np.load(directory / FRAMES_NAME, mmap_mode='r')
+    clean_frame = np.load(directory / CLEAN_NAME)
+    return frames, clean_frame
@@ -0,0 +1,216 @@
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# JSON lines events are appended to the file named by this environment
+# variable, so worker processes started by a pool inherit the destination
+METRICS_ENV = 'RAINY_METRICS_JSONL'
+PREFIX = 'rainy_'
+LOGGER = 'rainy'
+LOG_FORMATS = ('text', 'json')
+
+# upper bounds in seconds for timer histograms
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, math.inf)
+
+class Timer:
+    '''
+    Result of Metrics.timer, seconds is set when the block exits
+    '''
+    def __init__(self):
+        self.seconds = None
+
+class Metrics:
+    '''
+    Process-local counters and histograms plus a JSON lines event log
+
+    counters are keyed by name and labels, histograms (timers) by name only so
+    that per-scene or per-place fields go to the event log rather than into
+    the Prometheus label space.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            hist = self.histograms.setdefault(name, {'count': 0, 'sum': 0.0, 'buckets': [0]*len(BUCKETS)})
+            hist['count'] += 1
+            hist['sum'] += value
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    hist['buckets'][i] += 1
+
+    def drain(self):
+        '''
+        Counters and histograms recorded since the last drain, for a pool
+        worker to send back with its result. Resets them in this process.
+        '''
+        with self.lock:
+            snapshot = {'counters': self.counters, 'histograms': self.histograms}
+            self.counters = {}
+            self.histograms = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        '''
+        Add the observations drained in another process
+        '''
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, other in snapshot['histograms'].items():
+                hist = self.histograms.setdefault(name, {'count': 0, 'sum': 0.0, 'buckets': [0]*len(BUCKETS)})
+                hist['count'] += other['count']
+                hist['sum'] += other['sum']
+                hist['buckets'] = [a + b for a, b in zip(hist['buckets'], other['buckets'])]
+
+    def event(self, name, **fields):
+        '''
+        Append one JSON line to the event log, if one is configured
+        '''
+        path = os.environ.get(METRICS_ENV)
+        if not path:
+            return
+        line = json.dumps({'time': time.time(), 'pid': os.getpid(), 'event': name, **fields}, default=str)
+        with self.lock:
+            with open(path, 'a') as f:
+                f.write(line + '\n')
+
+    @contextmanager
+    def timer(self, name, **fields):
+        '''
+        Time a block. Records <name>_seconds in a histogram and logs an event
+        with the duration, fields, and whether the block raised.
+        '''
+        timer = Timer()
+        status = 'ok'
+        start = time.perf_counter()
+        try:
+            yield timer
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            timer.seconds = time.perf_counter() - start
+            self.observe(f'{name}_seconds', timer.seconds)
+            self.incr(f'{name}_total', status=status)
+            self.event(name, seconds=timer.seconds, status=status, **fields)
+
+    def prometheus_text(self):
+        '''
+        Current values in the Prometheus text exposition format
+        '''
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f'{PREFIX}{name}{{{label_text}}} {value}')
+            for name, hist in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {PREFIX}{name} histogram')
+                for bound, count in zip(BUCKETS, hist['buckets']):
+                    le = '+Inf' if bound == math.inf else bound
+                    lines.append(f'{PREFIX}{name}_bucket{{le="{le}"}} {count}')
+                lines.append(f'{PREFIX}{name}_sum {hist["sum"]}')
+                lines.append(f'{PREFIX}{name}_count {hist["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='0.0.0.0'):
+        '''
+        Serve prometheus_text at /metrics from a background thread
+        '''
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                data = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+METRICS = Metrics()
+
+class StructuredFormatter(logging.Formatter):
+    '''
+    Formats a record as its message followed by key=value fields, or as one
+    JSON object per line with time, level, logger, message, and the fields
+    '''
+    def __init__(self, json_lines=False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        if self.json_lines:
+            data = {'time': record.created, 'level': record.levelname, 'logger': record.name, 'message': record.getMessage(), **fields}
+            if record.exc_info:
+                data['exception'] = self.formatException(record.exc_info)
+            return json.dumps(data, default=str)
+        text = record.getMessage()
+        if record.levelno >= logging.WARNING:
+            text = f'[{record.levelname}] {text}'
+        if fields:
+            text += ' ' + ' '.join(f'{k}={v}' for k, v in fields.items())
+        if record.exc_info:
+            text += '\n' + self.formatException(record.exc_info)
+        return text
+
+class FieldLogger(logging.LoggerAdapter):
+    '''
+    Logger taking structured fields as keyword arguments:
+    logger.info('skip', city='Paris', reason='dark')
+    '''
+    def process(self, msg, kwargs):
+        fields = {k: kwargs.pop(k) for k in list(kwargs) if k not in ('exc_info', 'stack_info', 'stacklevel', 'extra')}
+        kwargs['extra'] = {'fields': fields}
+        return msg, kwargs
+
+def get_logger(name):
+    return FieldLogger(logging.getLogger(f'{LOGGER}.{name}'), {})
+
+def configure_logging(log_format='text', level=logging.INFO, stream=None):
+    '''
+    Send rainy.* log records to stream (Default: stdout) formatted by
+    StructuredFormatter
+    '''
+    logger = logging.getLogger(LOGGER)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    handler.setFormatter(StructuredFormatter(json_lines=log_format == 'json'))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+def configure(jsonl=None, port=None, log_format='text'):
+    '''
+    Set up logging, and enable the JSON lines event log at path jsonl and/or
+    the Prometheus endpoint on port
+    '''
+    configure_logging(log_format)
+    if jsonl:
+        os.environ[METRICS_ENV] = os.path.abspath(os.path.expanduser(jsonl))
+    if port:
+        METRICS.serve(port)
@@ -1,95 +1,271 @@
 #!/usr/bin/env python3
 
-import gspread
+import os
+import shutil
 from pathlib import Path
 import argparse
 from processor_utils import *
 from processor_utils_spanet import *
-from tqdm import tqdm
-from PIL import Image
-import time
-from datetime import timedelta
+from processor_writer import FrameWriter, FORMATS
+from processor_manifest import *
+from dataset_export import SHARD_DIR, export_scene
+from frame_store import write_scene, open_scene
+from scene_index import CACHE_DIR, load_scene_index, select_rows, scene_names, iter_scenes
+from fingerprint import load_index, flagged_clips
+from metrics import METRICS, LOG_FORMATS, get_logger, configure as configure_metrics
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+
+logger = get_logger('processor')
+
+def process_scene(scene, params):
+    '''
+    reads the rainy video, generates the SPAN frame, reads the clean frame, and
+    saves the dataset images for one scene
+
+    Returns
+    -------
+    bool ret (False if the video could not be read) AND list of (level,
+    message, fields) log records, logged by the parent in scene order AND list
+    of Paths written
+    '''
+    log = []
+    scene_name = scene['name']
+    with METRICS.timer('scene', scene=scene_name) as scene_timer:
+        ret, outputs = generate_scene(scene, params, log)
+    log.append(('info', 'total', {'seconds': round(scene_timer.seconds, 3)}))
+    return ret, log, outputs
+
+def process_scene_worker(scene, params):
+    '''
+    process_scene in a pool worker, also returning the metrics it recorded so
+    the parent can merge them into its /metrics endpoint
+    '''
+    return process_scene(scene, params), METRICS.drain()
+
+def generate_scene(scene, params, log):
+    '''
+    process_scene without the total timing, appends log records to log
+    '''
+    scene_name = scene['name']
+
+    # read video (or map it from the frame store), generate SPAN frame, read clean frame
+    store = params['frame_store']
+    stored = open_scene(store, scene) if store else None
+    if stored is not None:
+        frames, clean_frame = stored
+        log.append(('info', 'mapped frames', {'store': store}))
+        METRICS.incr('frame_store_hits')
+    else:
+        with METRICS.timer('decode', scene=scene_name, decoder=params['decoder']) as t:
+            if params['decoder'] == 'ffmpeg':
+                ret, frames, clean_frame = read_scene_ffmpeg(scene)
+            else:
+                ret, frames = read_video(scene)
+                clean_frame = read_clean(scene) if ret else None
+        if ret == False:
+            log.append(('error', 'read video failed', {'decoder': params['decoder']}))
+            return False, []
+        log.append(('info', 'read video', {'seconds': round(t.seconds, 3), 'decoder': params['decoder']}))
+        if store:
+            write_scene(store, scene, frames, clean_frame, video_fps(scene['rainy_video_path']))
+            frames, clean_frame = open_scene(store, scene)
+    with METRICS.timer('span', scene=scene_name, sparsity=scene['sparsity']) as t:
+        if params['sweep']:
+            # one pass for the scene's sparsity and every swept frame count
+            sweep = SPAN_gen_sweep(frames, params['sweep'] + (scene['sparsity'],))
+            SPAN_frame = sweep[min(scene['sparsity'], frames.shape[0])]
+        else:
+            sweep = {}
+            SPAN_frame = SPAN_gen_single(frames, num_frames=scene['sparsity'])
+    log.append(('info', 'gen span', {'seconds': round(t.seconds, 3), 'sparsity': scene['sparsity']}))
+
+    # create folders to write to
+    scene_path = Path(params['save_dir'] / scene['name'])
+    scene_path.mkdir(parents=True, exist_ok=True)
+    scene_sample_path = Path(scene_path / 'sample')
+    scene_sample_path.mkdir(parents=True, exist_ok=True)
+    # start the optional folders empty, so a rebuild keeps no sweep or mask
+    # images from earlier options (other counts, format, or the option off)
+    for folder, wanted in (('sweep', sweep), ('mask', params['masks'])):
+        if (scene_path / folder).exists():
+            shutil.rmtree(scene_path / folder)
+        if wanted and not params['packed']:
+            (scene_path / folder).mkdir()
+
+    if params['masks']:
+        with METRICS.timer('masks', scene=scene_name):
+            masks, binary_masks = get_rain_masks(frames, clean_frame, binary_value=255)
+
+    # packed dataset: every frame goes into the scene's tar shards, only the samples are images
+    if params['packed']:
+        with METRICS.timer('save', scene=scene_name, format='tar') as t, FrameWriter(params['format'], params['compress_level'], params['writer_threads']) as writer:
+            outputs = export_scene(params['save_dir'] / SHARD_DIR, scene, frames, SPAN_frame, clean_frame, sweep,
+                                   *((masks, binary_masks) if params['masks'] else ()))
+            writer.write(SPAN_frame, scene_sample_path, scene_name+'-Webcam-P-000')
+            writer.write(clean_frame, scene_sample_path, scene_name+'-Webcam-C-000')
+            for i in (0, 10, 20):
+                if i < frames.shape[0]:
+                    writer.write(frames[i], scene_sample_path, scene_name+f'-Webcam-R-{i:03d}')
+            outputs += list(writer.futures)
+            failures = writer.wait()
+        log.append(('info', 'saving', {'seconds': round(t.seconds, 3), 'format': 'tar'}))
+        for path_name, e in failures:
+            log.append(('error', 'write failed', {'path': path_name, 'error': e}))
+        return len(failures) == 0, outputs
+
+    # generate dataset
+    with METRICS.timer('save', scene=scene_name, format=params['format']) as t, FrameWriter(params['format'], params['compress_level'], params['writer_threads']) as writer:
+        SPAN_path = writer.write(SPAN_frame, scene_path, scene_name+'-Webcam-P-000')
+        clean_path = writer.write(clean_frame, scene_path, scene_name+'-Webcam-C-000')
+        for count, frame in sweep.items():
+            writer.write(frame, scene_path / 'sweep', scene_name+f'-Webcam-P-{count:03d}')
+        if params['masks']:
+            for i in range(frames.shape[0]):
+                writer.write(masks[i], scene_path / 'mask', scene_name+f'-Webcam-M-{i:03d}')
+                writer.write(binary_masks[i], scene_path / 'mask', scene_name+f'-Webcam-B-{i:03d}')
+        raw_paths = [writer.write(frames[i], scene_path, scene_name+f'-Webcam-R-{i:03d}') for i in range(frames.shape[0])]
+
+        # samples for quick checking, linked rather than encoded again
+        for path in [SPAN_path, clean_path] + [raw_paths[i] for i in (0, 10, 20) if i < len(raw_paths)]:
+            writer.link(path, scene_sample_path)
+        outputs = list(writer.futures)
+        failures = writer.wait()
+    log.append(('info', 'saving', {'seconds': round(t.seconds, 3), 'format': params['format']}))
+    METRICS.incr('frames_written', len(outputs) - len(failures))
+
+    for path_name, e in failures:
+        log.append(('error', 'write failed', {'path': path_name, 'error': e}))
+    return len(failures) == 0, outputs
+
+def run_scenes(scenes, params, jobs=1):
+    '''
+    Processes scenes with process_scene and yields (index, scene, (ret, log, outputs)) in
+    the order given, regardless of the order in which they finish.
+
+    With jobs > 1, scenes are distributed over a process pool so that decoding,
+    SPAN generation, and saving of different scenes run at the same time. Each
+    worker handles a whole scene, which keeps frame stacks inside the process
+    that decoded them instead of pickling them between stages. The metrics
+    each worker records are merged into this process's METRICS.
+
+    Parameters
+    ----------
+    scenes : Iterable[Tuple[int, dict]]
+        (index, scene) pairs, consumed lazily
+
+    params : dict
+        processing parameters passed to process_scene
+
+    jobs : int
+        number of worker processes. 1 processes scenes in this process.
+    '''
+    if jobs == 1:
+        for i, scene in scenes:
+            yield i, scene, process_scene(scene, params)
+        return
+
+    # keep a bounded number of scenes submitted so results stream in order
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        in_flight = deque()
+        for i, scene in scenes:
+            in_flight.append((i, scene, pool.submit(process_scene_worker, scene, params)))
+            if len(in_flight) >= 2*jobs:
+                i, scene, future = in_flight.popleft()
+                result, observations = future.result()
+                METRICS.merge(observations)
+                yield i, scene, result
+        while in_flight:
+            i, scene, future = in_flight.popleft()
+            result, observations = future.result()
+            METRICS.merge(observations)
+            yield i, scene, result
 
 def main():
     parser = argparse.ArgumentParser("post-processor for downloaded videos")
     parser.add_argument('-s', '--sheet', type=str, default='downloads_first_pass', help='name of Google Sheet with metadata. Default: \'downloads_first_pass\'')
     parser.add_argument('-i', '--input-folder', type=str, default='./downloads', help='parent directory relative to paths of videos specified in Google Sheet. Default: ./downloads')
     parser.add_argument('-o', '--output-folder', type=str, default='./new-dataset', help='directory of dataset generated. Default: ./new-dataset')
+    parser.add_argument('--select', type=str, action='append', default=[], help='only process scenes matching this glob: name:GLOB, date:GLOB, place:GLOB, or a bare GLOB matching any of them. Can be repeated.')
+    parser.add_argument('--sheet-cache', type=str, default=CACHE_DIR, help=f'folder caching the parsed sheet. Default: ./{CACHE_DIR}')
+    parser.add_argument('--sheet-max-age', type=float, default=0, help='minutes a cached copy of the sheet is used without fetching it, negative to never expire. Default: 0 (always fetch, the cache is only used if fetching fails)')
+    parser.add_argument('--refresh-sheet', default=False, action='store_true', help='fetch the sheet even if the cached copy is fresh')
     parser.add_argument('-n', type=int, default=0, help='number of scenes to skip processing')
     parser.add_argument('--one', default=False, action='store_true', help='process only one scene')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of scenes to process in parallel. Default: 1')
+    parser.add_argument('--decoder', type=str, default='ffmpeg', choices=('ffmpeg', 'opencv'), help='ffmpeg seeks, crops and converts to RGB inside an ffmpeg pipe; opencv reads every frame with cv2.VideoCapture. Default: ffmpeg')
+    parser.add_argument('--frame-store', type=str, default='', help='folder keeping decoded, cropped clips as memory-mapped .npy files. Reruns of a scene whose videos and crop are unchanged (e.g. with another sparsity) map them instead of decoding.')
+    parser.add_argument('--sweep', type=str, default='', help='comma separated frame counts, e.g. 10,20,50. Also writes the SPAN frame of each count to a sweep folder in every scene, computed in the same pass as the scene\'s own sparsity.')
+    parser.add_argument('--masks', default=False, action='store_true', help='also write the rain mask (rainy minus clean) and binary rain mask of every raw frame to a mask folder in every scene')
+    parser.add_argument('--packed', default=False, action='store_true', help=f'write each scene\'s frames as .npy members of tar shards in OUTPUT_FOLDER/{SHARD_DIR} with a sidecar index instead of individual images. Samples are still written as images.')
+    parser.add_argument('--format', type=str, default='png', choices=tuple(FORMATS), help='image format of the dataset. webp is lossless, ppm and npy are uncompressed. Default: png')
+    parser.add_argument('--compress-level', type=int, default=6, help='png compression level from 0 (none, fastest) to 9. Default: 6')
+    parser.add_argument('--writer-threads', type=int, default=None, help='number of threads encoding images in each --jobs process. Default: number of CPUs divided by --jobs, at least 1')
+    parser.add_argument('--skip-flagged', default=False, action='store_true', help='skip scenes whose rainy video is frozen or a duplicate according to the fingerprint index in the input folder (see fingerprint.py)')
+    parser.add_argument('--metrics', type=str, default='', help='append per-stage timings as JSON lines to this file')
+    parser.add_argument('--metrics-port', type=int, default=0, help='serve Prometheus metrics on this port at /metrics')
+    parser.add_argument('--log-format', type=str, default='text', choices=LOG_FORMATS, help='text: message followed by key=value fields; json: one JSON object per line. Default: text')
+    parser.add_argument('--force', default=False, action='store_true', help='rebuild scenes even if the build manifest shows them up to date')
     args = parser.parse_args()
+    configure_metrics(args.metrics, args.metrics_port, args.log_format)
     sheet_name = args.sheet
     downloads_folder = Path(args.input_folder).expanduser()
     new_dataset_folder = Path(args.output_folder).expanduser()
     num_to_skip = args.n
 
-    gc = gspread.service_account(filename="google-sheet-service-auth.json")
-    worksheet = gc.open(sheet_name).sheet1
-    scene_names, scenes = read_spreadsheet(worksheet, downloads_folder)
-    print(f'number of scenes: {len(scenes)}')
-    print(f'number of scene names: {len(scene_names)}')
+    def fetch_sheet():
+        import gspread
+        gc = gspread.service_account(filename="google-sheet-service-auth.json")
+        return gc.open(sheet_name).sheet1.get_all_values()
+    with METRICS.timer('sheet_fetch', sheet=sheet_name):
+        rows = load_scene_index(sheet_name, fetch_sheet, args.sheet_cache, 60*args.sheet_max_age, args.refresh_sheet)
+    rows = select_rows(rows, args.select)
+    logger.info('sheet loaded', sheet=sheet_name, rows=len(rows), scene_names=len(scene_names(rows)))
+
+    # --one processes scenes one at a time until the first one succeeds
+    jobs = 1 if args.one else max(1, args.jobs)
 
     # Parameters
     params = {
         'save_dir': new_dataset_folder, # dir to save SPAN images
+        'decoder': args.decoder, # video decoding backend
+        'frame_store': Path(args.frame_store).expanduser() if args.frame_store else None, # decoded clip cache
+        'sweep': tuple(int(c) for c in args.sweep.split(',')) if args.sweep else None, # extra SPAN frame counts
+        'masks': True if args.masks else None, # write rain masks of every raw frame
+        'packed': True if args.packed else None, # write tar shards instead of images
+        'format': args.format, # image format of saved frames
+        'compress_level': args.compress_level, # png compression level
+        'writer_threads': args.writer_threads or max(1, (os.cpu_count() or 1) // jobs), # threads encoding images per scene
     }
     new_dataset_folder.mkdir(parents=True, exist_ok=True)
 
+    # skip scenes whose spreadsheet row, videos, and outputs are unchanged since the last build
+    # rows are validated and fingerprinted as the pipeline asks for the next scene
+    manifest = load_manifest(new_dataset_folder)
+    flagged = flagged_clips(load_index(downloads_folder)) if args.skip_flagged else set()
+    fingerprints = {}
+    def pending():
+        for i, scene in enumerate(iter_scenes(rows, downloads_folder)):
+            if i < num_to_skip:
+                continue
+            if str(scene['rainy_video_path'].relative_to(downloads_folder)) in flagged:
+                logger.info('skip', index=i, scene=scene['name'], reason='frozen or duplicate')
+                continue
+            fingerprint = scene_fingerprint(scene, params)
+            if not args.force and is_up_to_date(manifest, new_dataset_folder, scene['name'], fingerprint):
+                logger.info('skip', index=i, scene=scene['name'], reason='up to date')
+                continue
+            fingerprints[i] = fingerprint
+            yield i, scene
+
     # used to test SPANet frames to determine which number of frames should be used
-    for i, scene in enumerate(scenes):
-        if i < num_to_skip:
-            continue
-        print(f'{i}: {scene["name"]}')
-        time_global_start = time.time()
-        
-        # read video, generate SPAN frame, read clean frame
-        time_start = time.time()
-        ret, frames = read_video(scene)
-        if ret == False:
-            continue
-        print(f'\tRead video: {timedelta(seconds=int(time.time()-time_start))}')
-        time_start = time.time()
-        SPAN_frame = SPAN_gen_single(frames, num_frames=scene['sparsity'])
-        print(f'\tGen SPAN: {timedelta(seconds=int(time.time()-time_start))}')
-        clean_frame = read_clean(scene)
-
-        # create folders to write to
-        scene_path = Path(params['save_dir'] / scene['name'])
-        scene_path.mkdir(parents=True, exist_ok=True)
-        scene_sample_path = Path(scene_path / 'sample')
-        scene_sample_path.mkdir(parents=True, exist_ok=True)
-
-        # generate dataset
-        time_start = time.time()
-        scene_name = scene['name']
-        Image.fromarray(SPAN_frame.astype(np.uint8)).save(scene_path / (scene_name+'-Webcam-P-000.png'))
-        Image.fromarray(clean_frame.astype(np.uint8)).save(scene_path / (scene_name+'-Webcam-C-000.png'))
-        for i in range(frames.shape[0]):
-            Image.fromarray(frames[i].astype(np.uint8)).save(scene_path / (scene_name+f'-Webcam-R-{i:03d}.png'))
-
-        # samples for quick checking
-        Image.fromarray(SPAN_frame.astype(np.uint8)).save(scene_sample_path / (scene['name']+'-Webcam-P-000.png'))
-        Image.fromarray(clean_frame.astype(np.uint8)).save(scene_sample_path / (scene['name']+'-Webcam-C-000.png'))
-        Image.fromarray(frames[0].astype(np.uint8)).save(scene_sample_path / (scene['name']+f'-Webcam-R-000.png'))
-        Image.fromarray(frames[10].astype(np.uint8)).save(scene_sample_path / (scene['name']+f'-Webcam-R-010.png'))
-        Image.fromarray(frames[20].astype(np.uint8)).save(scene_sample_path / (scene['name']+f'-Webcam-R-020.png'))
-        print(f'\tSaving: {timedelta(seconds=int(time.time()-time_start))}')
-
-        for i in tqdm(range(frames.shape[0]), leave=False):
-            path_name = scene_path / Path(scene['name']+f'-Webcam-R-{i:03d}.png')
-            if not path_name.exists():
-                print(f"ruh roh... this file doesn't exist (;_;): {path_name}")
-
-        path_name = scene_path / Path(scene['name']+'-Webcam-P-000.png')
-        if not path_name.exists():
-            print(f"ruh roh... this file doesn't exist (;_;): {path_name}")
-        
-        path_name = scene_path / Path(scene['name']+'-Webcam-C-000.png')
-        if not path_name.exists():
-            print(f"ruh roh... this file doesn't exist (;_;): {path_name}")
-        print(f'\tTotal: {timedelta(seconds=int(time.time()-time_global_start))}')
-
-        if args.one:
+    for i, scene, (ret, log, outputs) in run_scenes(pending(), params, jobs):
+        for level, message, fields in log:
+            getattr(logger, level)(message, index=i, scene=scene['name'], **fields)
+        if ret:
+            record_scene(manifest, new_dataset_folder, scene['name'], fingerprints[i], outputs)
+            save_manifest(new_dataset_folder, manifest)
+        if ret and args.one:
             break
 
 if __name__ == "__main__":
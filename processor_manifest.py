@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+MANIFEST_NAME = 'build_manifest.json'
+
+# processing parameters that change the files a scene produces; the decoders
+# can differ in seeking and color conversion, so their frames are not identical
+OUTPUT_PARAMS = ('format', 'sweep', 'masks', 'packed', 'decoder')
+
+def file_identity(path: Path):
+    '''
+    Cheap identity of a source file: size and modification time
+    '''
+    st = Path(path).stat()
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def scene_fingerprint(scene, params):
+    '''
+    Fingerprint of everything a scene's outputs depend on
+
+    Parameters
+    ----------
+    scene : dict
+        scene from read_spreadsheet
+
+    params : dict
+        processing parameters, only OUTPUT_PARAMS that are set are used
+
+    Returns
+    -------
+    dict with a hash of the spreadsheet row and output parameters, and the
+    identities of the rainy and clean videos
+    '''
+    row = {k: str(v) if isinstance(v, Path) else v for k, v in scene.items()}
+    options = {k: params[k] for k in OUTPUT_PARAMS if params.get(k) is not None}
+    encoded = json.dumps({'row': row, 'options': options}, sort_keys=True).encode()
+    return {
+        'params_hash': hashlib.sha256(encoded).hexdigest(),
+        'rainy_video': file_identity(scene['rainy_video_path']),
+        'clean_video': file_identity(scene['clean_video_path']),
+    }
+
+def load_manifest(folder: Path):
+    '''
+    Returns
+    -------
+    dict keyed by scene name with 'fingerprint' and 'outputs' (paths relative
+    to folder). Empty if the folder has no manifest yet.
+    '''
+    path = Path(folder) / MANIFEST_NAME
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(folder: Path, manifest):
+    '''
+    Atomically replaces the manifest so an interrupted run keeps the scenes it
+    finished
+    '''
+    path = Path(folder) / MANIFEST_NAME
+    tmp_path = path.with_suffix('.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def is_up_to_date(manifest, folder: Path, name, fingerprint):
+    '''
+    True if the scene was built from the same inputs and all of its recorded
+    outputs are still present
+    '''
+    entry = manifest.get(name)
+    if entry is None or entry['fingerprint'] != fingerprint:
+        return False
+    return all((Path(folder) / output).exists() for output in entry['outputs'])
+
+def record_scene(manifest, folder: Path, name, fingerprint, outputs):
+    manifest[name] = {
+        'fingerprint': fingerprint,
+        'outputs': sorted(str(Path(output).relative_to(folder)) for output in outputs),
+    }
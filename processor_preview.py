@@ -1,27 +1,150 @@
 #!/usr/bin/env python3
 import argparse
+import html
+import math
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import sys
 import cv2
-from processor_utils import preview_crop
+import numpy as np
+from processor_utils import preview_crop, render_crop_preview
+from scene_index import CACHE_DIR, load_scene_index, select_rows, iter_scenes
+
+def read_frame(video_path, frame_num=0, seconds=-1):
+    '''
+    Seek directly to a frame with CAP_PROP_POS_FRAMES instead of reading every
+    frame before it
+
+    Returns
+    -------
+    RGB frame or None AND fps (0 if the video has no frames) AND frame number
+    '''
+    video = cv2.VideoCapture(str(video_path))
+    if video.get(cv2.CAP_PROP_FRAME_COUNT) == 0:
+        return None, 0, frame_num
+    fps = video.get(cv2.CAP_PROP_FPS)
+    if seconds != -1:
+        frame_num = int(fps*seconds)
+    video.set(cv2.CAP_PROP_POS_FRAMES, max(frame_num, 0))
+    ret, frame = video.read()
+    video.release()
+    if not ret:
+        return None, fps, frame_num
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), fps, frame_num
+
+def render_scene(scene, out_dir: Path, width=480):
+    '''
+    Write the darkened-crop preview of a scene's first frame, scaled to width
+
+    Returns
+    -------
+    dict with the scene name, preview file name (None if the frame could not
+    be read), frame number, and crop
+    '''
+    frame, _, frame_num = read_frame(scene['rainy_video_path'], scene['start_frame'], scene['seconds'])
+    result = {
+        'name': scene['name'],
+        'file': None,
+        'frame': frame_num,
+        'crop': (scene['l'], scene['r'], scene['t'], scene['b']),
+    }
+    if frame is None:
+        return result
+    preview = render_crop_preview(frame, *result['crop'])
+    h, w = preview.shape[:2]
+    preview = cv2.resize(preview, (width, max(1, round(h * width / w))), interpolation=cv2.INTER_AREA)
+    result['file'] = scene['name'] + '.jpg'
+    cv2.imwrite(str(out_dir / result['file']), cv2.cvtColor(preview, cv2.COLOR_RGB2BGR))
+    return result
+
+def contact_sheet(out_dir: Path, results, columns=4, width=480, label_height=24):
+    '''
+    Tile the rendered previews into one image, each labelled with its scene
+    name, frame, and crop
+    '''
+    rendered = [r for r in results if r['file'] is not None]
+    if not rendered:
+        return None
+    images = [cv2.imread(str(out_dir / r['file'])) for r in rendered]
+    cell_h = max(img.shape[0] for img in images) + label_height
+    rows = math.ceil(len(images) / columns)
+    sheet = np.zeros((rows * cell_h, columns * width, 3), dtype=np.uint8)
+    for k, (r, img) in enumerate(zip(rendered, images)):
+        y, x = (k // columns) * cell_h, (k % columns) * width
+        sheet[y:y + img.shape[0], x:x + img.shape[1]] = img
+        label = f"{r['name']}  frame {r['frame']}  crop {','.join(map(str, r['crop']))}"
+        cv2.putText(sheet, label, (x + 4, y + cell_h - 7), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 255, 255), 1, cv2.LINE_AA)
+    path = out_dir / 'contact_sheet.jpg'
+    cv2.imwrite(str(path), sheet)
+    return path
+
+def gallery(out_dir: Path, results):
+    '''
+    Write index.html showing every preview with its scene name, frame, and crop
+    '''
+    items = []
+    for r in results:
+        caption = html.escape(f"{r['name']} | frame {r['frame']} | crop {','.join(map(str, r['crop']))}")
+        if r['file'] is None:
+            items.append(f'<figure><figcaption>{caption} | could not read frame</figcaption></figure>')
+        else:
+            items.append(f'<figure><img src="{html.escape(r["file"])}" loading="lazy"><figcaption>{caption}</figcaption></figure>')
+    path = out_dir / 'index.html'
+    with open(path, 'w') as f:
+        f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>crop previews</title>\n'
+                '<style>body{font-family:sans-serif;background:#222;color:#eee}'
+                'figure{display:inline-block;margin:6px}figcaption{font-size:12px}</style>\n'
+                '</head><body>\n' + '\n'.join(items) + '\n</body></html>\n')
+    return path
+
+def batch(args):
+    def fetch_sheet():
+        import gspread
+        gc = gspread.service_account(filename="google-sheet-service-auth.json")
+        return gc.open(args.sheet).sheet1.get_all_values()
+    rows = load_scene_index(args.sheet, fetch_sheet, args.sheet_cache, 60*args.sheet_max_age, args.refresh_sheet)
+    rows = select_rows(rows, args.select)
+    scenes = list(iter_scenes(rows, Path(args.input_folder).expanduser()))
+    out_dir = Path(args.output_folder).expanduser()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    print(f'rendering {len(scenes)} scenes', file=sys.stderr)
+
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        results = list(pool.map(render_scene, scenes, [out_dir]*len(scenes), [args.width]*len(scenes)))
+    for r in results:
+        if r['file'] is None:
+            print(f"[ERROR] bad frame: {r['name']}", file=sys.stderr)
+    print(gallery(out_dir, results))
+    sheet = contact_sheet(out_dir, results, args.columns, args.width)
+    if sheet is not None:
+        print(sheet)
 
 def main():
     parser = argparse.ArgumentParser('preview crops and other data before processing')
-    parser.add_argument('video_path', type=str, help='path to video')
+    parser.add_argument('video_path', type=str, nargs='?', default='', help='path to video. Omit with --sheet.')
     parser.add_argument('-c', '--crop', type=str, default='', help='crop with format: L,R,T,B')
     parser.add_argument('-f', '--frame', type=int, default=0, help='frame number')
     parser.add_argument('-t', '--seconds', type=float, default=-1, help='number of seconds into video. Overrides --frame if specified.')
+    parser.add_argument('-s', '--sheet', type=str, default='', help='batch mode: render the crop of every scene in this Google Sheet to an HTML gallery and a contact sheet')
+    parser.add_argument('-i', '--input-folder', type=str, default='./downloads', help='batch mode: parent directory of the videos in the sheet. Default: ./downloads')
+    parser.add_argument('-o', '--output-folder', type=str, default='./previews', help='batch mode: folder for previews, index.html, and contact_sheet.jpg. Default: ./previews')
+    parser.add_argument('--select', type=str, action='append', default=[], help='batch mode: only scenes matching this glob, as for processor.py. Can be repeated.')
+    parser.add_argument('--sheet-cache', type=str, default=CACHE_DIR, help=f'folder caching the parsed sheet. Default: ./{CACHE_DIR}')
+    parser.add_argument('--sheet-max-age', type=float, default=0, help='minutes a cached copy of the sheet is used without fetching it, negative to never expire. Default: 0 (always fetch, the cache is only used if fetching fails)')
+    parser.add_argument('--refresh-sheet', default=False, action='store_true', help='fetch the sheet even if the cached copy is fresh')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='batch mode: number of scenes rendered in parallel. Default: 4')
+    parser.add_argument('-w', '--width', type=int, default=480, help='batch mode: width of each preview in pixels. Default: 480')
+    parser.add_argument('--columns', type=int, default=4, help='batch mode: previews per row of the contact sheet. Default: 4')
     args = parser.parse_args()
 
+    if args.sheet:
+        batch(args)
+        return
+    if args.video_path == '':
+        parser.error('a video_path or --sheet is required')
+
     # check inputs
     video_path = Path(args.video_path)
-    video = cv2.VideoCapture(str(video_path))
-    if video.get(cv2.CAP_PROP_FRAME_COUNT) == 0:
-        print('[ERROR] invalid video')
-        exit(1)
-    fps = video.get(cv2.CAP_PROP_FPS)
-    print(f'FPS: {fps}')
-
     if args.crop == '':
         crop = (0, -1, 0, -1)
     else:
@@ -31,22 +154,17 @@ def main():
         exit(1)
     L, R, T, B = crop
 
-    frame_num = args.frame
-
-    if args.seconds != -1:
-        frame_num = int(fps*args.seconds)
+    frame, fps, frame_num = read_frame(video_path, args.frame, args.seconds)
+    if fps == 0:
+        print('[ERROR] invalid video')
+        exit(1)
+    print(f'FPS: {fps}')
     print(f'FRAME: {frame_num}')
-
-    # read frame
-    for _ in range(frame_num):
-        video.read()
-    ret, frame = video.read()
-    if not ret:
+    if frame is None:
         print('[ERROR] bad frame', file=sys.stderr)
         exit(1)
-    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    
+
     preview_crop(frame, L, R, T, B)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
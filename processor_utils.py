@@ -1,11 +1,14 @@
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
 from pathlib import Path
-from PIL import Image
 import sys
+import subprocess
+import json
+from processor_utils_percentile import tiles, TILE_SIZE
+from scene_index import parse_rows, scene_names, iter_scenes
 
 def show_img(img, grey=False):
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(15, 8))
     if grey:
         plt.imshow(img, cmap='gray', vmin=0, vmax=1)
@@ -14,62 +17,16 @@ def show_img(img, grey=False):
     plt.show()
 
 def read_spreadsheet(worksheet, folder_path: Path):
-    data = worksheet.get_all_values()
-    rows = len(data)
-
-    # currently only loading scenes with both a rainy and clean video in spreadsheet
-    scenes = []
-    scene_names = {}
-    for i in range(1, rows):
-        if data[i][0] != '':
-            date = data[i][0]
-        if data[i][1] != '' and data[i][2] != '':
-            rainy_video_path = Path(folder_path / date / (data[i][1] + '.mp4'))
-            clean_video_path = Path(folder_path / date / (data[i][2] + '.mp4'))
-            if not rainy_video_path.exists():
-                print(f"ruh roh... this rainy vid doesn't exist (;_;): {rainy_video_path}")
-                continue
-            if not clean_video_path.exists():
-                print(f"ruh roh... this clean vid doesn't exist (;_;): {clean_video_path}")
-                continue
-            if data[i][5] == '':
-                print("No cropping is available...")
-                continue
-            if (data[i][9] == '') and (data[i][11] == ''):
-                print("No timestamps available...")
-                continue
-            if data[i][12] == '':
-                print("No clean frames available...")
-                continue
-            if data[i][13] == '':
-                print("No sparsity frame count for SPANet...")
-                continue
-            if data[i][14] == '':
-                print("No name...")
-                continue
-            scene_data = {
-                'l' : int(data[i][5]),
-                'r' : int(data[i][6]),
-                't' : int(data[i][7]),
-                'b' : int(data[i][8]),
-                'rainy_video_path' : rainy_video_path,
-                'clean_video_path': clean_video_path,
-                'start_frame' : -1 if data[i][9] == '' else int(data[i][9]),
-                'num_frames' : -1 if data[i][10] == '' else int(data[i][10]),
-                'seconds' : -1 if data[i][11] == '' else int(data[i][11]),
-                'clean_frame': int(data[i][12]),
-                'sparsity' : int(data[i][13]),
-                'name' : data[i][14]
-            }
-            print(scene_data)
-            scenes.append(scene_data)
-
-            name, right = data[i][14].split("-", 1)
-            if name in scene_names.keys():
-                scene_names[name] += 1
-            else:
-                scene_names[name] = 1
-    return scene_names, scenes
+    '''
+    Eagerly parse and validate every row of a worksheet, see scene_index for
+    the cached, lazy loader used by processor.py
+
+    Returns
+    -------
+    number of scenes per scene name AND list of valid scenes
+    '''
+    scenes = list(iter_scenes(parse_rows(worksheet.get_all_values()), folder_path))
+    return scene_names(scenes), scenes
 
 def read_video(scene):
     '''
@@ -110,9 +67,12 @@ def read_video(scene):
     for i in range(start_frame):
         video.read()
     # create return array
-    frames = np.zeros((num_frames, height, width, 3))
+    frames = np.zeros((num_frames, height, width, 3), dtype=np.uint8)
     for i in range(num_frames):
-        _, frame = video.read()
+        ret, frame = video.read()
+        if not ret:
+            print(f'[ERROR] bad video - only {i} of {num_frames} frames read', file=sys.stderr)
+            return False, np.array([0])
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         frame = frame[crop_T:crop_B,crop_L:crop_R,:]
         frames[i] = frame
@@ -133,32 +93,204 @@ def read_clean(scene):
     frame = frame[crop_T:crop_B,crop_L:crop_R,:]
     return frame
 
+def video_fps(video_path):
+    video = cv2.VideoCapture(str(video_path))
+    fps = video.get(cv2.CAP_PROP_FPS)
+    video.release()
+    return fps
+
+def probe_video(video_path):
+    '''
+    Returns
+    -------
+    width, height, and frame rate of the first video stream, read with ffprobe,
+    or None if the file is missing, corrupt, or has no video stream
+    '''
+    ffprobe_args = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height,r_frame_rate',
+        '-of', 'json',
+        str(video_path)]
+    try:
+        out = subprocess.run(ffprobe_args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, check=True).stdout
+        stream = json.loads(out)['streams'][0]
+        num, den = stream['r_frame_rate'].split('/')
+        return int(stream['width']), int(stream['height']), float(num) / float(den)
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError, IndexError, ZeroDivisionError) as e:
+        print(f'[ERROR] ffprobe failed for {video_path}: {e!r}', file=sys.stderr)
+        return None
+
+def ffmpeg_open(video_path, start_frame, num_frames, fps, crop_L, crop_R, crop_T, crop_B):
+    '''
+    Spawn ffmpeg decoding num_frames frames from start_frame, cropped and
+    converted to rgb24 inside ffmpeg, written raw to its stdout
+    '''
+    ffmpeg_args = [
+        'ffmpeg',
+        '-v', 'error',
+        '-nostdin',
+        '-ss', f'{start_frame / fps:.6f}', # accurate input seek
+        '-i', str(video_path),
+        '-an',
+        '-vf', f'crop={crop_R - crop_L}:{crop_B - crop_T}:{crop_L}:{crop_T}',
+        '-frames:v', str(num_frames),
+        '-pix_fmt', 'rgb24',
+        '-f', 'rawvideo',
+        '-']
+    return subprocess.Popen(ffmpeg_args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+
+def ffmpeg_readinto(p, frames):
+    '''
+    Read raw frames from an ffmpeg process straight into a preallocated uint8
+    array
+
+    Returns
+    -------
+    number of complete frames read
+    '''
+    buf = memoryview(frames.reshape(-1))
+    filled = 0
+    while filled < len(buf):
+        n = p.stdout.readinto(buf[filled:])
+        if not n:
+            break
+        filled += n
+    p.stdout.close()
+    p.wait()
+    return filled // frames[0].nbytes
+
+def read_scene_ffmpeg(scene):
+    '''
+    read_video and read_clean through ffmpeg pipes. The rainy and clean videos
+    are decoded by two ffmpeg processes running at the same time.
+
+    returns bool ret AND rainy frames AND clean frame:
+        True: read successful
+        False: read not successful, i.e. bad crop, unreadable video, or
+            fewer than num_frames frames decoded
+    '''
+    start_frame = scene['start_frame']
+    num_frames = 300 if scene['num_frames'] == -1 else scene['num_frames']
+    seconds = scene['seconds']
+    crop_L = scene['l']
+    crop_R = scene['r']
+    crop_B = scene['b']
+    crop_T = scene['t']
+
+    if (crop_R <= crop_L and crop_R != -1) or (crop_B <= crop_T and crop_B != -1):
+        print('[ERROR] bad crop', file=sys.stderr)
+        return False, np.array([0]), None
+
+    rainy_probe = probe_video(scene['rainy_video_path'])
+    clean_probe = probe_video(scene['clean_video_path'])
+    if rainy_probe is None or clean_probe is None:
+        print('[ERROR] bad video - ffprobe found no video stream', file=sys.stderr)
+        return False, np.array([0]), None
+    width_max, height_max, fps = rainy_probe
+    if seconds != -1:
+        start_frame = int(fps * seconds)
+        print(f'\t{seconds}s into the video corresponds to {start_frame} frames')
+    crop_R = width_max if crop_R < 0 else crop_R
+    crop_B = height_max if crop_B<0 else crop_B
+    height = crop_B - crop_T
+    width = crop_R - crop_L
+
+    clean_fps = clean_probe[2]
+    p_rainy = ffmpeg_open(scene['rainy_video_path'], max(start_frame, 0), num_frames, fps, crop_L, crop_R, crop_T, crop_B)
+    p_clean = ffmpeg_open(scene['clean_video_path'], scene['clean_frame'], 1, clean_fps, crop_L, crop_R, crop_T, crop_B)
+
+    frames = np.zeros((num_frames, height, width, 3), dtype=np.uint8)
+    clean_frame = np.zeros((height, width, 3), dtype=np.uint8)
+    read = ffmpeg_readinto(p_rainy, frames)
+    read_clean_frames = ffmpeg_readinto(p_clean, clean_frame[None])
+    if read < num_frames:
+        # the zeros left in frames would otherwise go into SPAN and the masks as black frames
+        print(f'[ERROR] bad video - only {read} of {num_frames} frames decoded', file=sys.stderr)
+        return False, np.array([0]), None
+    if read_clean_frames == 0:
+        print('[ERROR] bad clean video - no frame decoded', file=sys.stderr)
+        return False, np.array([0]), None
+    return True, frames, clean_frame
+
+def get_rain_masks(frames, clean, threshold=20, binary_value=1, out=None, out_binary=None, tile_size=TILE_SIZE):
+    '''
+    Continuous and binary rain masks of a stack of frames against a clean frame
+    in one pass. Differences are computed in int16 into buffers of tile_size
+    pixels, so no full-size temporaries are allocated.
+
+    Parameters
+    ----------
+    frames : np.ndarray
+        uint8 array of shape (N, H, W, 3)
+
+    clean : np.ndarray
+        uint8 array of shape (H, W, 3)
+
+    threshold : int, Default: 20
+        a pixel is rain in the binary mask if rainy > clean + threshold in all
+        three channels
+
+    binary_value : int, Default: 1
+        value of rain pixels in the binary mask, e.g. 255 for viewable images
+
+    out, out_binary : np.ndarray, Default: None
+        optional preallocated uint8 arrays of shape (N, H, W, 3) and (N, H, W)
+
+    Returns
+    -------
+    uint8 masks max(rainy - clean, 0) of shape (N, H, W, 3) AND uint8 binary
+    masks of shape (N, H, W)
+    '''
+    n = frames.shape[0]
+    if out is None:
+        out = np.empty(frames.shape, dtype=np.uint8)
+    if out_binary is None:
+        out_binary = np.empty(frames.shape[:3], dtype=np.uint8)
+    pixels = frames.shape[1] * frames.shape[2]
+    flat = frames.reshape(n, pixels, 3)
+    flat_clean = clean.reshape(pixels, 3)
+    flat_out = out.reshape(n, pixels, 3)
+    flat_binary = out_binary.reshape(n, pixels)
+
+    dif_buf = np.empty((min(tile_size, pixels), 3), dtype=np.int16)
+    min_buf = np.empty(min(tile_size, pixels), dtype=np.int16)
+    for tile in tiles(pixels, tile_size):
+        size = tile.stop - tile.start
+        dif = dif_buf[:size]
+        dif_min = min_buf[:size]
+        for i in range(n):
+            np.subtract(flat[i, tile], flat_clean[tile], out=dif, dtype=np.int16)
+            np.min(dif, axis=1, out=dif_min)
+            np.greater(dif_min, threshold, out=flat_binary[i, tile], casting='unsafe')
+            np.maximum(dif, 0, out=dif)
+            flat_out[i, tile] = dif
+    if binary_value != 1:
+        out_binary *= np.uint8(binary_value)
+    return out, out_binary
+
 def get_rain_mask(rain, clean):
-    rain = rain.astype('int32')
-    clean = clean.astype('int32')
-    dif = rain-clean
-    dif = np.clip(dif, 0, 255)
-    # show_img(dif, grey=True)
-    return dif
+    return get_rain_masks(rain[None], clean)[0][0]
 
 def get_rain_mask_binary(rain, clean):
-    rain = rain.astype('int32')
-    clean = clean.astype('int32')
-    dif = rain - (clean+20) # criterion for rain: rainy > clean + 20 across all three channels
+    return get_rain_masks(rain[None], clean)[1][0]
 
-    dif_r = np.clip(dif[:, :, 0], 0, 1)
-    dif_g = np.clip(dif[:, :, 1], 0, 1)
-    dif_b = np.clip(dif[:, :, 2], 0, 1)
-
-    dif = np.minimum(dif_r, dif_g, dif_b)
-    return dif
+def render_crop_preview(image, l=0, r=-1, t=0, b=-1, out=None):
+    '''
+    Image with everything outside the crop darkened to a third, rendered with
+    numpy
 
-def preview_crop(image, l=0, r=-1, t=0, b=-1):
-    preview_crop = image.copy() # h, w, c
+    Returns
+    -------
+    uint8 array of the same shape as image
+    '''
+    if out is None:
+        out = image.copy() # h, w, c
+    else:
+        out[...] = image
     h = image.shape[0]
     w = image.shape[1]
-    print(f'height: {h}')
-    print(f'width:  {w}')
 
     # no params default to no crop
     if r == -1:
@@ -170,14 +302,17 @@ def preview_crop(image, l=0, r=-1, t=0, b=-1):
     if t == -1:
         t = 0
 
-    preview_crop[:,0:l,:] = image[:,0:l,:]/3
-    preview_crop[:,r:w,:] = image[:,r:w,:]/3
-    preview_crop[0:t,:,:] = image[0:t,:,:]/3
-    preview_crop[b:h,:,:] = image[b:h,:,:]/3
+    for region in (out[:,0:l,:], out[:,r:w,:], out[0:t,l:r,:], out[b:h,l:r,:]):
+        region //= 3
+    return out
 
-    show_img(preview_crop)
+def preview_crop(image, l=0, r=-1, t=0, b=-1):
+    print(f'height: {image.shape[0]}')
+    print(f'width:  {image.shape[1]}')
+    show_img(render_crop_preview(image, l, r, t, b))
 
 def crop_and_save(images, l, r, t, b, save_dir, name):
+    from PIL import Image
     if len(images.shape) == 3: # input is single image
         cropped_image = images[t:b,l:r,:]
         Image.fromarray(cropped_image).save(f'{save_dir}/{name}.png')
@@ -0,0 +1,79 @@
+import numpy as np
+
+# ITU-R BT.601 luma weights in float64. Integer approximations (e.g. 2**16
+# fixed point) truncate exact-integer lumas one level low, which shifts the
+# SPAN percentile, so the product is done in float64 like the original code.
+LUMA_WEIGHTS = np.array([0.29900, 0.58700, 0.11400])
+
+YCBCR_MATRIX = np.array([[ 0.29900, -0.16874,  0.50000],
+                         [ 0.58700, -0.33126, -0.41869],
+                         [ 0.11400,  0.50000, -0.08131]], dtype=np.float32)
+YCBCR_OFFSET = np.array([0.0, 128.0, 128.0], dtype=np.float32)
+
+def _as_stack(rgb):
+    '''
+    View a single (H, W, 3) image or an (..., H, W, 3) stack as (N, H, W, 3)
+    '''
+    return rgb.reshape((-1,) + rgb.shape[-3:])
+
+def rgb_to_luma(rgb, out=None, method='float'):
+    '''
+    Luma (Y of YCbCr) of an RGB uint8 image or stack of images
+
+    Parameters
+    ----------
+    rgb : np.ndarray
+        uint8 array of shape (..., H, W, 3)
+
+    out : np.ndarray, Default: None
+        optional preallocated uint8 array of shape (..., H, W)
+
+    method : str, Default: float
+        'float' for a float64 product truncated to uint8 (bit-identical to the
+        YCbCr matrix product followed by a uint8 cast), 'cv2' for cv2.cvtColor
+        (rounding)
+
+    Returns
+    -------
+    uint8 array of shape (..., H, W)
+    '''
+    if out is None:
+        out = np.empty(rgb.shape[:-1], dtype=np.uint8)
+    frames = _as_stack(rgb)
+    out_frames = out.reshape((-1,) + out.shape[-2:])
+
+    if method == 'cv2':
+        import cv2
+        for i in range(frames.shape[0]):
+            cv2.cvtColor(np.ascontiguousarray(frames[i]), cv2.COLOR_RGB2GRAY, dst=out_frames[i])
+        return out
+    if method != 'float':
+        raise ValueError(f'unknown luma method: {method}')
+
+    # one frame at a time keeps the float64 temporary at H x W; a matrix-vector
+    # product (not r*wr + g*wg + b*wb) keeps the rounding of np.dot(rgb, matrix)
+    for i in range(frames.shape[0]):
+        np.copyto(out_frames[i], np.dot(frames[i], LUMA_WEIGHTS), casting='unsafe')
+    return out
+
+def rgb_to_ycbcr(rgb, out=None):
+    '''
+    Full YCbCr conversion of an RGB uint8 image or stack of images. Works frame
+    by frame in float32 and clips to [0, 255] before the uint8 cast (Cb and Cr
+    can reach 255.5 for saturated blue and red).
+
+    Returns
+    -------
+    uint8 array with the same shape as rgb
+    '''
+    if out is None:
+        out = np.empty(rgb.shape, dtype=np.uint8)
+    frames = _as_stack(rgb)
+    out_frames = _as_stack(out)
+    tmp = np.empty(frames.shape[1:], dtype=np.float32)
+    for i in range(frames.shape[0]):
+        np.matmul(frames[i].astype(np.float32), YCBCR_MATRIX, out=tmp)
+        tmp += YCBCR_OFFSET
+        np.clip(tmp, 0, 255, out=tmp)
+        np.copyto(out_frames[i], tmp, casting='unsafe')
+    return out
@@ -0,0 +1,186 @@
+import numpy as np
+
+HIST_BINS = 256
+# number of pixel positions whose histograms are held in memory at once
+TILE_SIZE = 1 << 15
+
+def tiles(length, tile_size=TILE_SIZE):
+    '''
+    Yields slices covering range(length) in chunks of tile_size
+    '''
+    for start in range(0, length, tile_size):
+        yield slice(start, min(start + tile_size, length))
+
+def hist_offsets(positions):
+    return np.arange(positions, dtype=np.intp) * HIST_BINS
+
+def hist_update(flat_counts, offsets, frame, sign=1):
+    '''
+    Adds (sign=1) or removes (sign=-1) one uint8 frame of shape (P,) from the
+    flattened (P*256,) histograms. Each position contributes exactly one index,
+    so a plain fancy-index increment is safe.
+    '''
+    flat_counts[offsets + frame] += sign
+
+def stack_histogram(stack):
+    '''
+    Per-position histograms of a uint8 stack
+
+    Parameters
+    ----------
+    stack : np.ndarray
+        uint8 array of shape (n, P)
+
+    Returns
+    -------
+    np.ndarray of shape (P, 256) with the number of occurrences of each value
+    '''
+    counts = np.zeros((stack.shape[1], HIST_BINS), dtype=np.int32)
+    flat = counts.reshape(-1)
+    offsets = hist_offsets(stack.shape[1])
+    for frame in stack:
+        hist_update(flat, offsets, frame)
+    return counts
+
+def sliding_histograms(stack, starts, length):
+    '''
+    Yields (window index, histograms) for each window stack[s:s+length] with s
+    in the increasing sequence starts. The histograms are updated in place by
+    removing the frames leaving the window and adding the frames entering it,
+    so every frame is touched at most twice regardless of the overlap.
+
+    Parameters
+    ----------
+    stack : np.ndarray
+        uint8 array of shape (n, P)
+
+    starts : Iterable[int]
+        increasing window start indices
+
+    length : int
+        number of frames per window
+    '''
+    counts = np.zeros((stack.shape[1], HIST_BINS), dtype=np.int32)
+    flat = counts.reshape(-1)
+    offsets = hist_offsets(stack.shape[1])
+    prev = None
+    for k, s in enumerate(starts):
+        if prev is None or s >= prev + length:
+            counts[:] = 0
+            for i in range(s, s + length):
+                hist_update(flat, offsets, stack[i])
+        else:
+            for i in range(prev, s):
+                hist_update(flat, offsets, stack[i], -1)
+            for i in range(prev + length, s + length):
+                hist_update(flat, offsets, stack[i])
+        prev = s
+        yield k, counts
+
+def growing_histograms(stack, counts):
+    '''
+    Yields (frame count, histograms) of stack[:c] for each c in the increasing
+    sequence counts. Frames are added to the same histograms one at a time, so
+    all snapshots together cost one pass over the largest count.
+
+    Parameters
+    ----------
+    stack : np.ndarray
+        uint8 array of shape (n, P)
+
+    counts : Iterable[int]
+        increasing frame counts, at most n
+    '''
+    hist = np.zeros((stack.shape[1], HIST_BINS), dtype=np.int32)
+    flat = hist.reshape(-1)
+    offsets = hist_offsets(stack.shape[1])
+    added = 0
+    for c in counts:
+        for i in range(added, c):
+            hist_update(flat, offsets, stack[i])
+        added = c
+        yield c, hist
+
+def hist_select(cum, rank):
+    '''
+    Value at 0-indexed sorted position rank for each row of cumulative histograms
+    '''
+    return np.count_nonzero(cum <= rank, axis=1)
+
+def histogram_percentile(counts, n, q):
+    '''
+    Percentile q (0-100) of each row of histograms holding n samples.
+    Matches np.percentile with the default 'linear' interpolation.
+
+    Returns
+    -------
+    np.ndarray of float64 with shape (P,)
+    '''
+    cum = np.cumsum(counts, axis=1, dtype=np.int32)
+    virtual = np.true_divide(q, 100) * (n - 1)
+    below = int(np.floor(virtual))
+    above = min(below + 1, n - 1)
+    gamma = virtual - below
+    a = hist_select(cum, below).astype(np.float64)
+    if gamma == 0:
+        return a
+    b = hist_select(cum, above).astype(np.float64)
+    # same formulation as numpy's _lerp so truncation to uint8 agrees
+    diff = b - a
+    if gamma >= 0.5:
+        return b - diff * (1 - gamma)
+    return a + diff * gamma
+
+def percentile_uint8(stack, q):
+    '''
+    np.percentile(stack, q, axis=0) for uint8 stacks using counting selection
+    instead of sorting
+
+    Parameters
+    ----------
+    stack : np.ndarray
+        uint8 array of shape (n, ...)
+
+    q : float
+        percentile between 0 and 100
+
+    Returns
+    -------
+    np.ndarray of float64 with shape stack.shape[1:]
+    '''
+    n = stack.shape[0]
+    flat = stack.reshape(n, -1)
+    out = np.empty(flat.shape[1], dtype=np.float64)
+    for tile in tiles(flat.shape[1]):
+        out[tile] = histogram_percentile(stack_histogram(flat[:, tile]), n, q)
+    return out.reshape(stack.shape[1:])
+
+def span_percentile_votes(counts, n):
+    '''
+    Histogram form of the per-pixel statistics gathered by
+    processor_utils_spanet.job: for each pixel, the percentile range spanned by
+    its most frequent luma value. Returns the number of pixels covering each
+    percentile 0..100.
+    '''
+    rows = np.arange(counts.shape[0])
+    mode = counts.argmax(axis=1)
+    cum = np.cumsum(counts, axis=1, dtype=np.int32)
+    last = cum[rows, mode] - 1
+    first = last + 1 - counts[rows, mode]
+    lo = np.ceil(first / n * 100).astype(np.intp)
+    hi = np.floor(last / n * 100).astype(np.intp)
+    valid = lo <= hi
+    diff = np.bincount(lo[valid], minlength=102)[:102] - np.bincount(hi[valid] + 1, minlength=102)[:102]
+    return np.cumsum(diff)[:101]
+
+def span_percentile(y):
+    '''
+    Same result as processor_utils_spanet.computer_percentile computed from
+    histograms in a single process
+    '''
+    n = y.shape[0]
+    flat = y.reshape(n, -1)
+    votes = np.zeros(101, dtype=np.int64)
+    for tile in tiles(flat.shape[1]):
+        votes += span_percentile_votes(stack_histogram(flat[:, tile]), n)
+    return int(np.argmax(votes))
@@ -1,5 +1,7 @@
 import numpy as np
-import torch.multiprocessing as mp
+import multiprocessing as mp
+from processor_utils_percentile import *
+from processor_utils_color import rgb_to_luma, rgb_to_ycbcr
 
 def get_max_occur_number(arr):
     bc = np.bincount(arr)
@@ -84,31 +86,81 @@ def computer_percentile(y):
     percentile = np.argmax([np.sum(maps[:,i]) for i in range(0,101)])
     return percentile
 def RGB2YCbCr(rgb):
-        m = np.array([[ 0.29900, -0.16874,  0.50000],
-                    [0.58700, -0.33126, -0.41869],
-                    [ 0.11400, 0.50000, -0.08131]])
-        ycbcr = np.dot(rgb,m)
-        ycbcr[:,:,1:]+=128.0
-        return ycbcr.astype('uint8')
-
-
-def SPAN_gen_rolling(frames, num_frames): # helper function run SPAN code for 1 vid, more args can (and should) be added later
-    num_segments = frames.shape[0]//num_frames
-    SPAN_frames = np.zeros_like(frames)
-    for i in range(num_segments):
-        rgb = frames[num_frames*i:num_frames*(i+1)]
-        ycbcr = RGB2YCbCr(rgb)
-        y  = ycbcr[:,:,:,0]
-        percentile = computer_percentile(y) 
-        final = np.percentile(rgb,percentile,axis=0).astype('uint8')
-        for j in range(num_frames):
-            SPAN_frames[num_frames*i+j] = final
+    return rgb_to_ycbcr(np.asarray(rgb, dtype=np.uint8))
+
+
+def SPAN_gen_rolling(frames, num_frames, step=None): # helper function run SPAN code for 1 vid, more args can (and should) be added later
+    '''
+    SPAN frames for windows of num_frames frames starting every step frames
+    (default step=num_frames, i.e. non-overlapping segments). Each window's
+    SPAN frame is written to the frames from its start up to the next window's
+    start. Luma and RGB histograms are carried across windows and updated
+    incrementally, so the cost grows linearly with the number of frames.
+    '''
+    step = num_frames if step is None else step
+    n = frames.shape[0]
+    SPAN_frames = np.zeros(frames.shape, dtype=frames.dtype)
+    starts = list(range(0, n - num_frames + 1, step))
+    if len(starts) == 0:
+        return SPAN_frames, frames
+    rgb = np.ascontiguousarray(frames, dtype=np.uint8)
+
+    # pass 1: percentile for every window from luma histograms
+    y = rgb_to_luma(rgb).reshape(n, -1)
+    votes = np.zeros((len(starts), 101), dtype=np.int64)
+    for tile in tiles(y.shape[1]):
+        for k, counts in sliding_histograms(y[:, tile], starts, num_frames):
+            votes[k] += span_percentile_votes(counts, num_frames)
+    percentiles = votes.argmax(axis=1)
+
+    # pass 2: per-window percentile of every pixel and channel
+    flat = rgb.reshape(n, -1)
+    out = SPAN_frames.reshape(n, -1)
+    ends = starts[1:] + [starts[-1] + num_frames]
+    for tile in tiles(flat.shape[1]):
+        for k, counts in sliding_histograms(flat[:, tile], starts, num_frames):
+            final = histogram_percentile(counts, num_frames, percentiles[k]).astype('uint8')
+            out[starts[k]:ends[k], tile] = final
     return SPAN_frames, frames
 
+def SPAN_gen_sweep(frames, counts):
+    '''
+    SPAN frames of the first c frames for every c in counts, in one pass. The
+    luma and RGB histograms grow frame by frame and are read at each count,
+    so the result for each count equals SPAN_gen_single(frames, c).
+
+    Returns
+    -------
+    dict mapping each count (clipped to the number of frames) to its SPAN frame
+    '''
+    counts = sorted({min(max(1, int(c)), frames.shape[0]) for c in counts})
+    rgb = np.asarray(frames[:counts[-1]], dtype=np.uint8)
+    n = rgb.shape[0]
+
+    # pass 1: percentile for every count from luma histograms
+    y = rgb_to_luma(rgb).reshape(n, -1)
+    votes = np.zeros((len(counts), 101), dtype=np.int64)
+    for tile in tiles(y.shape[1]):
+        for k, (c, hist) in enumerate(growing_histograms(y[:, tile], counts)):
+            votes[k] += span_percentile_votes(hist, c)
+    percentiles = votes.argmax(axis=1)
+
+    # pass 2: per-count percentile of every pixel and channel
+    flat = rgb.reshape(n, -1)
+    out = {c: np.empty(rgb.shape[1:], dtype=np.uint8) for c in counts}
+    for tile in tiles(flat.shape[1]):
+        for k, (c, hist) in enumerate(growing_histograms(flat[:, tile], counts)):
+            out[c].reshape(-1)[tile] = histogram_percentile(hist, c, percentiles[k]).astype('uint8')
+    return out
+
 def SPAN_gen_single(frames, num_frames):
-    rgb = frames[:num_frames]
-    ycbcr = RGB2YCbCr(rgb)
-    y  = ycbcr[:,:,:,0]
-    percentile = computer_percentile(y) 
-    final = np.percentile(rgb,percentile,axis=0).astype('uint8')
-    return final
\ No newline at end of file
+    '''
+    SPAN frame from the first num_frames frames. frames may be a memmap (e.g.
+    from frame_store.open_scene); only the luma of the used frames is held in
+    memory, and the percentile comes from histograms (span_percentile) in this
+    process instead of computer_percentile's worker processes.
+    '''
+    rgb = np.asarray(frames[:num_frames], dtype=np.uint8)
+    percentile = span_percentile(rgb_to_luma(rgb))
+    final = percentile_uint8(rgb, percentile).astype('uint8')
+    return final
@@ -0,0 +1,122 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from PIL import Image
+
+# output format -> file extension
+FORMATS = {
+    'png': '.png',
+    'webp': '.webp', # lossless
+    'ppm': '.ppm',   # uncompressed
+    'npy': '.npy',   # uncompressed, raw numpy array
+}
+
+def save_image(image, path: Path, fmt='png', compress_level=6):
+    '''
+    Save a uint8 image of shape (H, W, 3) in one of FORMATS
+
+    Parameters
+    ----------
+    image : np.ndarray
+        image to save
+
+    path : Path
+        destination including extension
+
+    fmt : str, Default: png
+        key of FORMATS
+
+    compress_level : int, Default: 6
+        zlib compression level for png, 0 (none) to 9 (smallest)
+
+    Returns
+    -------
+    Path of the saved file
+    '''
+    if fmt == 'npy':
+        np.save(path, image)
+    elif fmt == 'png':
+        Image.fromarray(image).save(path, compress_level=compress_level)
+    elif fmt == 'webp':
+        Image.fromarray(image).save(path, lossless=True)
+    elif fmt == 'ppm':
+        Image.fromarray(image).save(path)
+    else:
+        raise ValueError(f'unknown image format: {fmt}')
+    return path
+
+def link_file(src: Path, dst: Path):
+    '''
+    Hard link src to dst, falling back to a copy across filesystems
+    '''
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+    return dst
+
+class FrameWriter:
+    '''
+    Writes images on a thread pool. Encoding (zlib for png, libwebp for webp)
+    releases the GIL, so several images are compressed at the same time.
+
+    Call wait() to block until everything submitted has been written; it
+    returns the files that failed together with their exception, so callers
+    do not need to stat the output afterwards.
+    '''
+    def __init__(self, fmt='png', compress_level=6, threads=None):
+        if fmt not in FORMATS:
+            raise ValueError(f'unknown image format: {fmt}. Choose from {tuple(FORMATS)}.')
+        self.fmt = fmt
+        self.ext = FORMATS[fmt]
+        self.compress_level = compress_level
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.futures = {}
+
+    def write(self, image, directory: Path, name: str) -> Path:
+        '''
+        Queue image to be saved as directory/name with this writer's extension
+        '''
+        path = Path(directory) / (name + self.ext)
+        self.futures[path] = self.pool.submit(save_image, image, path, self.fmt, self.compress_level)
+        return path
+
+    def link(self, src: Path, directory: Path) -> Path:
+        '''
+        Queue a hard link of a previously written file into directory
+        '''
+        dst = Path(directory) / src.name
+        src_future = self.futures[src]
+        def job():
+            src_future.result()
+            return link_file(src, dst)
+        self.futures[dst] = self.pool.submit(job)
+        return dst
+
+    def wait(self):
+        '''
+        Returns
+        -------
+        list of (Path, Exception) for every file that was not written
+        '''
+        failures = []
+        for path, future in self.futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                failures.append((path, e))
+        self.futures = {}
+        return failures
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
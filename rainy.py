@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+import importlib
+import sys
+
+# subcommand -> (module, description). Modules are imported only when their
+# subcommand runs, so e.g. `rainy.py preview` never loads the downloader.
+COMMANDS = {
+    'download': ('downloader2', 'download rainy and clean livestream clips'),
+    'filter': ('filter', 'classify downloaded videos as rainy or not'),
+    'process': ('processor', 'generate the dataset from the metadata sheet'),
+    'preview': ('processor_preview', 'preview crops of one video or a whole sheet'),
+    'fingerprint': ('fingerprint', 'flag frozen and duplicate clips'),
+    'export': ('dataset_export', 'pack processor output into tar shards'),
+    'storage': ('storage', 'report and limit the disk usage of downloads'),
+    'cluster': ('downloader_cluster', 'status, catalog merge, and selftest of sharded downloaders'),
+}
+
+def usage():
+    lines = ['usage: rainy.py COMMAND [ARGS ...]', '', 'commands:']
+    lines += [f'  {name.ljust(12)}{description}' for name, (_, description) in COMMANDS.items()]
+    lines += ['', 'run rainy.py COMMAND -h for the options of a command']
+    return '\n'.join(lines)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) == 0 or argv[0] in ('-h', '--help'):
+        print(usage())
+        return
+    command = argv[0]
+    if command not in COMMANDS:
+        print(usage(), file=sys.stderr)
+        print(f'\n[ERROR] unknown command: {command}', file=sys.stderr)
+        exit(2)
+    module_name = COMMANDS[command][0]
+    sys.argv = [f'{sys.argv[0]} {command}'] + argv[1:]
+    importlib.import_module(module_name).main()
+
+if __name__ == '__main__':
+    main()
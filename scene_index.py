@@ -0,0 +1,186 @@
+import fnmatch
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from clips import parse_clip_name
+
+CACHE_DIR = '.scene_cache'
+
+# spreadsheet columns
+DATE, RAINY, CLEAN = 0, 1, 2
+CROP_L, CROP_R, CROP_T, CROP_B = 5, 6, 7, 8
+START_FRAME, NUM_FRAMES, SECONDS, CLEAN_FRAME, SPARSITY, NAME = 9, 10, 11, 12, 13, 14
+
+def parse_rows(data):
+    '''
+    Turn the values of the metadata sheet into index rows without touching the
+    filesystem. The date column is filled forward and rows without both a
+    rainy and a clean video are dropped.
+
+    Returns
+    -------
+    list of dicts with 'row' (sheet row number), 'date', 'place' (from the
+    rainy video name), 'name', and 'values' (the raw cells of the row)
+    '''
+    rows = []
+    date = ''
+    for i in range(1, len(data)):
+        values = list(data[i]) + ['']*(NAME + 1 - len(data[i]))
+        if values[DATE] != '':
+            date = values[DATE]
+        if values[RAINY] == '' or values[CLEAN] == '':
+            continue
+        rows.append({
+            'row': i + 1,
+            'date': date,
+            'place': parse_clip_name(values[RAINY])[0] or '',
+            'name': values[NAME],
+            'values': values,
+        })
+    return rows
+
+def cache_file(cache_dir, sheet_name):
+    return Path(cache_dir) / (sheet_name.replace(os.sep, '_') + '.json')
+
+def load_scene_index(sheet_name, fetch, cache_dir=CACHE_DIR, max_age=0.0, refresh=False):
+    '''
+    Index rows of a metadata sheet, read from a local cache when possible
+
+    Parameters
+    ----------
+    sheet_name : str
+        name of the Google Sheet, also the cache key
+
+    fetch : Callable[[], List[List[str]]]
+        returns every value of the sheet, called unless a cached copy younger
+        than max_age is used. If it raises and a cached copy exists, the
+        cached copy is used with a warning.
+
+    cache_dir : str or Path or None, Default: '.scene_cache'
+        folder the parsed sheet is cached in, None disables the cache
+
+    max_age : float, Default: 0.0
+        seconds a cached copy is used without fetching, negative to never
+        expire. 0 always fetches, so edits to the sheet are seen at once.
+
+    refresh : bool, Default: False
+        fetch the sheet even if the cache is fresh
+
+    Returns
+    -------
+    list of index rows, see parse_rows
+    '''
+    path = None if cache_dir is None else cache_file(cache_dir, sheet_name)
+    cached = path is not None and path.exists()
+    if cached and not refresh and max_age != 0:
+        age = time.time() - path.stat().st_mtime
+        if max_age < 0 or age <= max_age:
+            print(f'using cached sheet {sheet_name}, fetched {age / 60:.1f} minutes ago (--refresh-sheet to fetch it)', file=sys.stderr)
+            with open(path) as f:
+                return json.load(f)['rows']
+
+    try:
+        rows = parse_rows(fetch())
+    except Exception as e:
+        if not cached:
+            raise
+        age = time.time() - path.stat().st_mtime
+        print(f'[WARNING] fetching sheet {sheet_name} failed ({e!r}), using the copy cached {age / 60:.1f} minutes ago', file=sys.stderr)
+        with open(path) as f:
+            return json.load(f)['rows']
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'sheet': sheet_name, 'fetched': time.time(), 'rows': rows}, f)
+        os.replace(tmp_path, path)
+    return rows
+
+def matches(row, pattern):
+    '''
+    Whether an index row matches a selection pattern. 'name:GLOB', 'date:GLOB',
+    and 'place:GLOB' match one field; a bare GLOB matches any of them.
+    '''
+    field, sep, glob = pattern.partition(':')
+    if sep and field in ('name', 'date', 'place'):
+        return fnmatch.fnmatchcase(row[field], glob)
+    return any(fnmatch.fnmatchcase(row[field], pattern) for field in ('name', 'date', 'place'))
+
+def select_rows(rows, patterns):
+    '''
+    Rows matching any of patterns, all rows if there are none
+    '''
+    if not patterns:
+        return rows
+    return [row for row in rows if any(matches(row, p) for p in patterns)]
+
+def scene_names(rows):
+    '''
+    Number of scenes per scene name prefix (the part of the name before '-'),
+    from index rows or scenes
+    '''
+    names = {}
+    for row in rows:
+        name = row['name'].split('-', 1)[0]
+        if name:
+            names[name] = names.get(name, 0) + 1
+    return names
+
+def row_scene(row, folder_path: Path):
+    '''
+    Validate one index row against the videos in folder_path
+
+    Returns
+    -------
+    scene dict, or None after printing why the row is skipped
+    '''
+    values = row['values']
+    rainy_video_path = Path(folder_path / row['date'] / (values[RAINY] + '.mp4'))
+    clean_video_path = Path(folder_path / row['date'] / (values[CLEAN] + '.mp4'))
+    if not rainy_video_path.exists():
+        print(f"ruh roh... this rainy vid doesn't exist (;_;): {rainy_video_path}")
+        return None
+    if not clean_video_path.exists():
+        print(f"ruh roh... this clean vid doesn't exist (;_;): {clean_video_path}")
+        return None
+    if values[CROP_L] == '':
+        print("No cropping is available...")
+        return None
+    if (values[START_FRAME] == '') and (values[SECONDS] == ''):
+        print("No timestamps available...")
+        return None
+    if values[CLEAN_FRAME] == '':
+        print("No clean frames available...")
+        return None
+    if values[SPARSITY] == '':
+        print("No sparsity frame count for SPANet...")
+        return None
+    if values[NAME] == '':
+        print("No name...")
+        return None
+    return {
+        'l' : int(values[CROP_L]),
+        'r' : int(values[CROP_R]),
+        't' : int(values[CROP_T]),
+        'b' : int(values[CROP_B]),
+        'rainy_video_path' : rainy_video_path,
+        'clean_video_path': clean_video_path,
+        'start_frame' : -1 if values[START_FRAME] == '' else int(values[START_FRAME]),
+        'num_frames' : -1 if values[NUM_FRAMES] == '' else int(values[NUM_FRAMES]),
+        'seconds' : -1 if values[SECONDS] == '' else int(values[SECONDS]),
+        'clean_frame': int(values[CLEAN_FRAME]),
+        'sparsity' : int(values[SPARSITY]),
+        'name' : values[NAME]
+    }
+
+def iter_scenes(rows, folder_path: Path):
+    '''
+    Yield valid scenes from index rows, checking each row only when it is
+    reached
+    '''
+    for row in rows:
+        scene = row_scene(row, folder_path)
+        if scene is not None:
+            yield scene
@@ -2,4 +2,4 @@
 python3 -m venv venv
 source ./venv/bin/activate
 pip3 install python-dotenv requests gspread timezonefinder pytz astral
-pip3 install opencv-python matplotlib tqdm torch
\ No newline at end of file
+pip3 install opencv-python matplotlib tqdm
\ No newline at end of file
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+from clips import find_videos, parse_clip_name
+
+# eviction policy -> sort key, clips that sort first are evicted first
+POLICIES = {
+    'oldest': lambda clip: (clip['time'],),
+    'non-rain-first': lambda clip: (clip['rain'], clip['time']),
+    'unverified-first': lambda clip: ({False: 0, None: 1, True: 2}[clip['verified']], clip['time']),
+}
+
+def sidecar_path(video_path: Path):
+    return video_path.with_suffix('.json')
+
+def clip_verified(video_path: Path):
+    '''
+    True/False if downloader2 --verify routed the clip to verified/ or
+    rejected/ (or recorded a result in the sidecar), None if never verified
+    '''
+    if video_path.parent.name in ('verified', 'rejected'):
+        return video_path.parent.name == 'verified'
+    data_path = sidecar_path(video_path)
+    if data_path.exists():
+        try:
+            with open(data_path) as f:
+                verification = json.load(f).get('rain_verification')
+        except (OSError, ValueError):
+            verification = None
+        if verification is not None:
+            return bool(verification['rainy'])
+    return None
+
+def scan_clips(folder: Path):
+    '''
+    Every downloaded clip under folder, laid out as
+    <day>/<weather>[/verified|rejected]/<place>_<time>[_<weather>].<ext>
+
+    Returns
+    -------
+    list of dicts with path, day, weather, place, time (datetime, file mtime
+    if the name cannot be parsed), bytes (video and sidecar), mtime, rain,
+    and verified
+    '''
+    folder = Path(folder)
+    clips = []
+    for file in find_videos(folder, recursive=True):
+        path = folder / file
+        parts = Path(file).parts
+        place, clip_time = parse_clip_name(path)
+        st = path.stat()
+        data_path = sidecar_path(path)
+        size = st.st_size + (data_path.stat().st_size if data_path.exists() else 0)
+        weather = parts[1] if len(parts) > 2 else ''
+        clips.append({
+            'path': path,
+            'day': parts[0] if len(parts) > 1 else '',
+            'weather': weather,
+            'place': place or path.stem,
+            'time': clip_time or datetime.datetime.utcfromtimestamp(st.st_mtime),
+            'bytes': size,
+            'mtime': st.st_mtime,
+            'rain': 'rain' in weather.split('-'),
+            'verified': clip_verified(path),
+        })
+    return clips
+
+def usage(clips, key):
+    '''
+    Returns
+    -------
+    dict mapping each value of clip[key] ('day', 'weather', 'place') to
+    [clip count, bytes]
+    '''
+    totals = {}
+    for clip in clips:
+        total = totals.setdefault(clip[key], [0, 0])
+        total[0] += 1
+        total[1] += clip['bytes']
+    return totals
+
+def plan_eviction(clips, quota_bytes, policy='oldest', protect_seconds=3600, now=None):
+    '''
+    Clips to evict, in policy order, until the remaining clips fit in
+    quota_bytes. Clips modified within protect_seconds are never chosen so
+    that recordings being moved or verified are left alone.
+    '''
+    now = time.time() if now is None else now
+    total = sum(clip['bytes'] for clip in clips)
+    candidates = sorted((c for c in clips if now - c['mtime'] > protect_seconds), key=POLICIES[policy])
+    evicted = []
+    for clip in candidates:
+        if total <= quota_bytes:
+            break
+        evicted.append(clip)
+        total -= clip['bytes']
+    return evicted
+
+def transcode(src: Path, dst: Path, crf=28):
+    '''
+    Re-encode a clip with H.264 at the given CRF, written to a temporary name
+    and renamed so an interrupted transcode leaves no partial clip
+
+    Returns
+    -------
+    bool success
+    '''
+    tmp_path = dst.with_name(dst.stem + '.part' + dst.suffix)
+    ffmpeg_args = [
+        'ffmpeg', '-v', 'error', '-nostdin', '-y',
+        '-i', str(src),
+        '-an',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', str(crf),
+        str(tmp_path)]
+    if subprocess.call(ffmpeg_args) != 0:
+        tmp_path.unlink(missing_ok=True)
+        return False
+    os.replace(tmp_path, dst)
+    return True
+
+def evict(clip, folder: Path, cold_dir: Path=None, crf=None, dry_run=False):
+    '''
+    Delete a clip and its sidecar, or move them to the same relative path
+    under cold_dir, re-encoding the video with crf if given
+
+    Returns
+    -------
+    bytes freed in folder
+    '''
+    path = clip['path']
+    data_path = sidecar_path(path)
+    action = 'delete' if cold_dir is None else ('transcode' if crf is not None else 'move')
+    print(f"{action} {path.relative_to(folder)}")
+    if dry_run:
+        return clip['bytes']
+    if cold_dir is not None:
+        dst = Path(cold_dir) / path.relative_to(folder)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if crf is not None:
+            if not transcode(path, dst.with_suffix('.mp4'), crf):
+                print(f"[ERROR] transcode failed, keeping {path}", file=sys.stderr)
+                return 0
+        else:
+            shutil.move(str(path), str(dst))
+        if data_path.exists():
+            shutil.move(str(data_path), str(sidecar_path(dst)))
+    path.unlink(missing_ok=True)
+    data_path.unlink(missing_ok=True)
+    return clip['bytes']
+
+def cold_clips(clips, after_days, today=None):
+    '''
+    Clips whose day folder is at least after_days days old
+    '''
+    today = datetime.datetime.utcnow().date() if today is None else today
+    cold = []
+    for clip in clips:
+        try:
+            day = datetime.datetime.strptime(clip['day'], '%Y-%m-%d').date()
+        except ValueError:
+            continue
+        if (today - day).days >= after_days:
+            cold.append(clip)
+    return cold
+
+def clean_tmp(tmp_dir: Path, max_age_hours=6.0, dry_run=False):
+    '''
+    Remove ffmpeg logs and failed partial recordings from tmp_dir that have
+    not been written to for max_age_hours, long after any recording would
+    have finished
+
+    Returns
+    -------
+    bytes freed
+    '''
+    tmp_dir = Path(tmp_dir)
+    if not tmp_dir.exists():
+        return 0
+    freed = 0
+    cutoff = time.time() - 3600*max_age_hours
+    for path in tmp_dir.iterdir():
+        if not path.is_file():
+            continue
+        st = path.stat()
+        if st.st_mtime < cutoff:
+            freed += st.st_size
+            if not dry_run:
+                path.unlink(missing_ok=True)
+    return freed
+
+def free_bytes(path: Path):
+    return shutil.disk_usage(path).free
+
+def maintain(folder: Path, quota_bytes=None, policy='oldest', cold_dir: Path=None, cold_after_days=None, crf=None, tmp_dir: Path=None, tmp_max_age_hours=6.0, dry_run=False):
+    '''
+    One storage pass: move cold days to cold_dir, clean tmp_dir, then evict
+    clips by policy until folder fits in quota_bytes. Evicted clips go to
+    cold_dir if one is given, otherwise they are deleted.
+
+    Returns
+    -------
+    bytes freed in folder (and tmp_dir)
+    '''
+    folder = Path(folder)
+    freed = 0
+    moving_cold = cold_dir is not None and cold_after_days is not None
+    clips = scan_clips(folder) if folder.exists() and (moving_cold or quota_bytes is not None) else []
+    if moving_cold:
+        cold = cold_clips(clips, cold_after_days)
+        for clip in cold:
+            freed += evict(clip, folder, cold_dir, crf, dry_run)
+        cold_paths = {clip['path'] for clip in cold}
+        clips = [clip for clip in clips if clip['path'] not in cold_paths]
+    if tmp_dir is not None:
+        freed += clean_tmp(tmp_dir, tmp_max_age_hours, dry_run)
+    if quota_bytes is not None:
+        for clip in plan_eviction(clips, quota_bytes, policy):
+            freed += evict(clip, folder, cold_dir, crf, dry_run)
+    return freed
+
+def print_usage(clips, key):
+    totals = usage(clips, key)
+    for value, (count, size) in sorted(totals.items()):
+        print(f'{key},{value},{count},{size}')
+
+def main():
+    parser = argparse.ArgumentParser(description='reports and limits the disk usage of downloaded videos')
+    parser.add_argument('folder', help='downloads folder')
+    parser.add_argument('--report', type=str, default='day', choices=('day', 'weather', 'place', 'none'), help='print clip count and bytes per day, weather, or place as CSV. Default: day')
+    parser.add_argument('--quota-gb', type=float, default=-1, help='evict clips until the folder uses at most this many GB, negative for no quota. Default -1.')
+    parser.add_argument('--policy', type=str, default='oldest', choices=tuple(POLICIES), help='order in which clips are evicted. Default: oldest')
+    parser.add_argument('--cold-dir', type=str, default='', help='move evicted clips and cold days here instead of deleting them')
+    parser.add_argument('--cold-after-days', type=int, default=-1, help='move day folders at least this many days old to --cold-dir, negative to disable. Default -1.')
+    parser.add_argument('--transcode-crf', type=int, default=-1, help='re-encode clips moved to --cold-dir with H.264 at this CRF, negative to move as is. Default -1.')
+    parser.add_argument('--tmp-dir', type=str, default='./tmp', help='downloader temporary folder to clean. Default: ./tmp')
+    parser.add_argument('--tmp-max-age', type=float, default=6.0, help='hours after which logs and partial recordings in --tmp-dir are removed. Default 6.')
+    parser.add_argument('--dry-run', default=False, action='store_true', help='print what would be evicted without changing anything')
+    args = parser.parse_args()
+    folder = Path(args.folder).expanduser()
+
+    cold_dir = Path(args.cold_dir).expanduser() if args.cold_dir else None
+    if args.cold_after_days >= 0 and cold_dir is None:
+        parser.error('--cold-after-days requires --cold-dir')
+    freed = maintain(
+        folder,
+        quota_bytes=int(args.quota_gb * 1e9) if args.quota_gb >= 0 else None,
+        policy=args.policy,
+        cold_dir=cold_dir,
+        cold_after_days=args.cold_after_days if args.cold_after_days >= 0 else None,
+        crf=args.transcode_crf if args.transcode_crf >= 0 else None,
+        tmp_dir=Path(args.tmp_dir).expanduser(),
+        tmp_max_age_hours=args.tmp_max_age,
+        dry_run=args.dry_run)
+    print(f'freed bytes: {freed}, free bytes: {free_bytes(folder)}', file=sys.stderr)
+    if args.report != 'none':
+        print_usage(scan_clips(folder), args.report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import subprocess
+import numpy as np
+from filter import temporal_pixel_stats, vote_rainy
+
+def probe_frames(manifest, seconds=3, fps=10, size=(160, 90)):
+    '''
+    Pull a few seconds of a livestream into memory as small grayscale frames
+
+    Parameters
+    ----------
+    manifest : str
+        HLS manifest URL
+
+    seconds : int, Default: 3
+        length of the stream to read
+
+    fps : int, Default: 10
+        frame rate to sample the stream at
+
+    size : Tuple[int, int], Default: (160, 90)
+        (width, height) the frames are scaled to
+
+    Returns
+    -------
+    uint8 array of shape (frames, height, width), empty if ffmpeg failed or
+    did not finish in time
+    '''
+    w, h = size
+    ffmpeg_args = [
+        'ffmpeg',
+        '-v', 'error',
+        '-f', 'hls',          # input format is hls
+        '-i', manifest,       # input manifest file link
+        '-t', str(seconds),   # time length to read
+        '-an',                # discard audio
+        '-vf', f'fps={fps},scale={w}:{h}',
+        '-pix_fmt', 'gray',
+        '-f', 'rawvideo',
+        '-']
+    try:
+        p = subprocess.run(
+            ffmpeg_args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=3*seconds + 30)
+    except subprocess.TimeoutExpired:
+        return np.zeros((0, h, w), dtype=np.uint8)
+    n = len(p.stdout) // (w*h)
+    return np.frombuffer(p.stdout[:n*w*h], dtype=np.uint8).reshape(n, h, w)
+
+def probe_stream(manifest, seconds=3, dark=25.0, frozen=0.5, rain_threshold=None):
+    '''
+    Decide from a short in-memory sample of a livestream whether it is worth
+    recording
+
+    Parameters
+    ----------
+    manifest : str
+        HLS manifest URL
+
+    seconds : int, Default: 3
+        length of the stream to sample
+
+    dark : float, Default: 25.0
+        reject if the mean intensity (0-255) is below this
+
+    frozen : float, Default: 0.5
+        reject if the largest mean absolute difference between consecutive
+        frames is below this, i.e. the image does not change
+
+    rain_threshold : float, Default: None
+        if given, reject unless the filter.py detector, run over every pixel of
+        the sample, finds at least this percentage of outliers
+
+    Returns
+    -------
+    bool ok AND str reason ('ok', 'no frames', 'dark', 'frozen', 'no rain')
+    AND dict of measured statistics
+    '''
+    frames = probe_frames(manifest, seconds)
+    stats = {'frames': len(frames)}
+    if len(frames) < 2:
+        return False, 'no frames', stats
+
+    stats['brightness'] = float(frames.mean())
+    if stats['brightness'] < dark:
+        return False, 'dark', stats
+
+    motion = np.abs(np.diff(frames.astype(np.int16), axis=0)).mean(axis=(1, 2))
+    stats['motion'] = float(motion.max())
+    if stats['motion'] < frozen:
+        return False, 'frozen', stats
+
+    if rain_threshold is not None:
+        intensities = frames.reshape(len(frames), -1)
+        rainy, _, _, _, _, percent_outliers = vote_rainy(*temporal_pixel_stats(intensities), len(frames), rain_threshold)
+        stats['percent_outliers'] = float(percent_outliers)
+        if not rainy:
+            return False, 'no rain', stats
+    return True, 'ok', stats
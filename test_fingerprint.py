@@ -0,0 +1,54 @@
+import datetime
+import os
+import fingerprint
+
+CLIP = 'Paris_2024-05-01_10-00-00_rain.mp4'
+FINGERPRINT = {'clip_hash': 0x0f0f, 'frame_hashes': [1, 2, 3], 'motion': 4.0, 'frozen': False}
+
+def make_clip(folder, relative):
+    path = folder / relative
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'video')
+    return path
+
+def test_moved_clip_keeps_fingerprint_and_is_not_a_duplicate(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(fingerprint, 'clip_fingerprint', lambda path, **options: calls.append(path) or dict(FINGERPRINT))
+    path = make_clip(tmp_path, f'2024-05-01/rain/{CLIP}')
+    index = fingerprint.update_index(tmp_path, {})
+    assert len(calls) == 1
+
+    # downloader2 --verify moves the clip into verified/
+    moved = tmp_path / '2024-05-01/rain/verified' / CLIP
+    moved.parent.mkdir()
+    os.replace(path, moved)
+    index = fingerprint.update_index(tmp_path, index)
+
+    key = f'2024-05-01/rain/verified/{CLIP}'
+    assert list(index) == [key]
+    assert index[key]['duplicate_of'] is None
+    assert len(calls) == 1
+    assert fingerprint.flagged_clips(index) == set()
+
+def test_deleted_original_clears_duplicate(tmp_path, monkeypatch):
+    monkeypatch.setattr(fingerprint, 'clip_fingerprint', lambda path, **options: dict(FINGERPRINT))
+    original = make_clip(tmp_path, f'2024-05-01/rain/{CLIP}')
+    make_clip(tmp_path, '2024-05-01/rain/Paris_2024-05-01_10-05-00_rain.mp4')
+    index = fingerprint.update_index(tmp_path, {})
+    assert index['2024-05-01/rain/Paris_2024-05-01_10-05-00_rain.mp4']['duplicate_of'] == f'2024-05-01/rain/{CLIP}'
+
+    original.unlink()
+    index = fingerprint.update_index(tmp_path, index)
+    assert list(index) == ['2024-05-01/rain/Paris_2024-05-01_10-05-00_rain.mp4']
+    assert fingerprint.flagged_clips(index) == set()
+
+def test_looping_place_is_skipped_until_its_latest_clip_ages_out(tmp_path, monkeypatch):
+    monkeypatch.setattr(fingerprint, 'clip_fingerprint', lambda path, **options: dict(FINGERPRINT))
+    make_clip(tmp_path, f'2024-05-01/rain/{CLIP}')
+    make_clip(tmp_path, '2024-05-01/rain/Paris_2024-05-01_10-05-00_rain.mp4')
+    index = fingerprint.update_index(tmp_path, {})
+
+    now = datetime.datetime(2024, 5, 1, 11)
+    assert fingerprint.looping_places(index, now=now) == {'Paris'}
+    assert fingerprint.frozen_places(index, now=now) == set()
+    assert fingerprint.looping_places(index, max_age_hours=0.5, now=now) == set()